@@ -0,0 +1,166 @@
+"""
+Concept image sets read straight from sharded tar archives.
+
+A shard holds any number of concept folders, laid out like the extracted
+``image/<axis>/<concept>`` tree: the images of a concept are the image
+members directly under its folder, and the ``.json`` members there are its
+metadata. Nothing is ever extracted to disk:
+
+- ``ShardIndex`` lists the members of every shard once (only the headers
+  are read for uncompressed shards) and caches the listing in ``cache_dir``,
+  keyed by the shard path, size and modification time.
+- ``read_concept`` reads the members of one concept into memory, shard by
+  shard in file order, with forward seeks for uncompressed shards and a
+  single streaming pass for compressed ones.
+
+The images are ``ArchiveImage`` objects that ``open_image`` (used by the
+datasets, the latent cache and the CLIP encoding) opens like paths.
+
+    python archive_source.py --train_archive "shards/*.tar" --list
+"""
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+class ArchiveImage:
+    def __init__(self, shard, name, data):
+        self.shard = shard
+        self.name = name
+        self.data = data
+
+    def __str__(self):
+        return f"{self.shard}::{self.name}"
+
+    __repr__ = __str__
+
+
+def open_image(source):
+    """``Image.open`` of a path or of an ``ArchiveImage``."""
+    if isinstance(source, ArchiveImage):
+        return Image.open(io.BytesIO(source.data))
+    return Image.open(source)
+
+
+def _is_compressed(shard):
+    with open(shard, "rb") as f:
+        magic = f.read(6)
+    return magic[:2] == b"\x1f\x8b" or magic[:3] == b"BZh" or magic == b"\xfd7zXZ\x00"
+
+
+class ShardIndex:
+    def __init__(self, shards, cache_dir=None):
+        self.shards = sorted(shards)
+        # concept -> [(shard, member name, offset of the data, size)]
+        self.concepts = {}
+        for shard in self.shards:
+            for name, offset, size in self._members(shard, cache_dir):
+                concept, _ = os.path.split(name)
+                self.concepts.setdefault(concept, []).append((shard, name, offset, size))
+
+    @classmethod
+    def from_pattern(cls, pattern, cache_dir=None):
+        shards = glob.glob(pattern)
+        if not shards:
+            raise FileNotFoundError(f"No archive shard matches {pattern}")
+        return cls(shards, cache_dir)
+
+    @staticmethod
+    def _members(shard, cache_dir):
+        cache_path = None
+        if cache_dir is not None:
+            stat = os.stat(shard)
+            key = f"{os.path.abspath(shard)}\n{stat.st_size}\n{stat.st_mtime_ns}"
+            key = hashlib.sha1(key.encode()).hexdigest()[:16]
+            cache_path = os.path.join(cache_dir, f"{os.path.basename(shard)}.{key}.json")
+            if os.path.isfile(cache_path):
+                with open(cache_path) as f:
+                    return json.load(f)
+
+        with tarfile.open(shard) as tar:
+            members = [
+                (os.path.normpath(m.name), m.offset_data, m.size) for m in tar if m.isfile()
+            ]
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(members, f)
+            os.replace(tmp_path, cache_path)
+        return members
+
+    def concept_names(self):
+        """Folders holding at least one image."""
+        return sorted(
+            concept for concept, members in self.concepts.items()
+            if any(name.lower().endswith(IMAGE_EXTENSIONS) for _, name, _, _ in members)
+        )
+
+    def read_concept(self, concept):
+        """The images (sorted by name) and the merged ``.json`` metadata of ``concept``."""
+        concept = os.path.normpath(concept)
+        if concept not in self.concepts:
+            raise KeyError(f"No concept {concept} in the archive shards")
+        by_shard = {}
+        for shard, name, offset, size in self.concepts[concept]:
+            by_shard.setdefault(shard, []).append((offset, name, size))
+
+        contents = {}
+        for shard, members in by_shard.items():
+            members.sort()
+            if _is_compressed(shard):
+                wanted = {name for _, name, _ in members}
+                with tarfile.open(shard, "r|*") as tar:
+                    for member in tar:
+                        name = os.path.normpath(member.name)
+                        if name in wanted:
+                            contents[name] = (shard, tar.extractfile(member).read())
+            else:
+                with open(shard, "rb") as f:
+                    for offset, name, size in members:
+                        f.seek(offset)
+                        contents[name] = (shard, f.read(size))
+
+        images, metadata = [], {}
+        for name in sorted(contents):
+            shard, data = contents[name]
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                images.append(ArchiveImage(shard, name, data))
+            elif name.lower().endswith(".json"):
+                metadata.update(json.loads(data))
+        if not images:
+            raise ValueError(f"No images for concept {concept} in the archive shards")
+        return images, metadata
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Index sharded concept archives.")
+    parser.add_argument('--train_archive', type=str, required=True, help='Glob pattern of the tar shards.')
+    parser.add_argument('--archive_index_cache', type=str, default='./archive_index', help='Directory of the cached shard listings.')
+    parser.add_argument('--list', action='store_true', help='Print every concept with its number of images.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    index = ShardIndex.from_pattern(args.train_archive, args.archive_index_cache)
+    concepts = index.concept_names()
+    print(f"{len(index.shards)} shards, {len(concepts)} concepts")
+    if args.list:
+        for concept in concepts:
+            num_images = sum(
+                name.lower().endswith(IMAGE_EXTENSIONS) for _, name, _, _ in index.concepts[concept]
+            )
+            print(f"{concept}\t{num_images}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Selectable attention backends for the UNet.
+
+The backend is set on the UNet processors, so it applies both to the
+training passes and to the ``DiffusionPipeline`` built around the same UNet.
+
+- ``default``: the processors the UNet was loaded with.
+- ``sliced``: attention computed one slice of heads at a time.
+- ``chunked``: attention computed for chunks of query positions, so only a
+  ``chunk_size x context`` score matrix is alive at a time.
+- ``sdpa``: fused ``torch.nn.functional.scaled_dot_product_attention``
+  (PyTorch >= 2.0).
+- ``xformers``: memory efficient attention from xformers.
+"""
+import torch
+
+try:
+    from diffusers.models.attention_processor import AttnProcessor
+except ImportError:  # diffusers < 0.15
+    from diffusers.models.cross_attention import CrossAttnProcessor as AttnProcessor
+
+try:
+    from diffusers.models.attention_processor import AttnProcessor2_0
+except ImportError:
+    try:
+        from diffusers.models.cross_attention import AttnProcessor2_0
+    except ImportError:
+        AttnProcessor2_0 = None
+
+ATTENTION_BACKENDS = ["default", "sliced", "chunked", "sdpa", "xformers"]
+
+
+class ChunkedAttnProcessor:
+    def __init__(self, chunk_size=1024):
+        self.chunk_size = chunk_size
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None):
+        batch_size, sequence_length, _ = hidden_states.shape
+        attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+        residual = hidden_states
+
+        query = attn.to_q(hidden_states)
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif getattr(attn, "norm_cross", None) is not None:
+            encoder_hidden_states = attn.norm_cross(encoder_hidden_states)
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        query = attn.head_to_batch_dim(query)
+        key = attn.head_to_batch_dim(key)
+        value = attn.head_to_batch_dim(value)
+
+        chunks = []
+        for start in range(0, query.shape[1], self.chunk_size):
+            end = start + self.chunk_size
+            mask = attention_mask
+            if mask is not None and mask.shape[1] > 1:
+                mask = mask[:, start:end]
+            attention_probs = attn.get_attention_scores(query[:, start:end], key, mask)
+            chunks.append(torch.bmm(attention_probs, value))
+        hidden_states = attn.batch_to_head_dim(torch.cat(chunks, dim=1))
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if getattr(attn, "residual_connection", False):
+            hidden_states = hidden_states + residual
+        return hidden_states / getattr(attn, "rescale_output_factor", 1.0)
+
+
+def set_attention_backend(unet, backend, slice_size=None, chunk_size=1024):
+    if backend == "default":
+        return
+    elif backend == "sliced":
+        unet.set_attention_slice("auto" if slice_size is None else slice_size)
+    elif backend == "chunked":
+        unet.set_attn_processor(ChunkedAttnProcessor(chunk_size))
+    elif backend == "sdpa":
+        if AttnProcessor2_0 is None or not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+            raise ValueError(
+                "The sdpa attention backend requires PyTorch >= 2.0 and a diffusers"
+                " version that provides AttnProcessor2_0"
+            )
+        unet.set_attn_processor(AttnProcessor2_0())
+    elif backend == "xformers":
+        unet.enable_xformers_memory_efficient_attention()
+    else:
+        raise ValueError(f"Unknown attention backend {backend}")
@@ -0,0 +1,113 @@
+"""
+Compiled attribute vocabularies.
+
+Compiling an attribute vocabulary file (one word or phrase per line) does all
+of its preprocessing once: token ids and token embeddings (the mean over the
+tokens of multi-token entries). The result is cached in the vocabulary cache
+directory under a key made of the hashes of the file and of the tokenizer and
+of the name of the model the embeddings come from, so the next runs only load
+it.
+
+    python attribute_vocabulary.py --vocabulary_path image/time/attr.txt
+
+The training scripts compile on a cache miss by themselves.
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import torch
+from transformers import CLIPTextModel, CLIPTokenizer
+
+from concept_library import file_hash
+from phrase_bank import compose_embeddings, read_attribute_vocabulary
+from resources import load_pretrained
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compile an attribute vocabulary into the vocabulary cache.")
+    parser.add_argument('--vocabulary_path', type=str, required=True, help='Path to the attribute words from LLM.')
+    parser.add_argument('--vocabulary_cache', type=str, default='./vocabulary_cache', help='Directory of the compiled attribute vocabularies.')
+    parser.add_argument('--pretrained_model_name_or_path', type=str, default='stabilityai/stable-diffusion-2-1-base', help='Model whose tokenizer and token embeddings are used.')
+    parser.add_argument('--offline', action='store_true', help='Never download models, fail if they are not cached locally.')
+    return parser.parse_args()
+
+
+def tokenizer_hash(tokenizer):
+    # The base vocabulary only, placeholder tokens added by the training do not count
+    vocab = getattr(tokenizer, "encoder", None) or tokenizer.get_vocab()
+    return hashlib.sha1(json.dumps(vocab, sort_keys=True).encode()).hexdigest()
+
+
+def vocabulary_key(vocabulary_path, tokenizer, text_encoder_name):
+    key = "\n".join([file_hash(vocabulary_path), tokenizer_hash(tokenizer), text_encoder_name])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def compile_attribute_vocabulary(vocabulary_path, tokenizer, token_table):
+    words, token_ids = read_attribute_vocabulary(vocabulary_path, tokenizer)
+    if not words:
+        raise ValueError(f"The attribute vocabulary {vocabulary_path} is empty")
+    return {
+        "vocabulary_path": os.path.abspath(vocabulary_path),
+        "words": words,
+        "token_ids": token_ids,
+        "embeddings": compose_embeddings(token_table.detach(), token_ids).float().cpu(),
+    }
+
+
+def load_attribute_vocabulary(vocabulary_path, tokenizer, token_table, cache_dir, text_encoder_name):
+    """The compiled vocabulary from ``cache_dir``, compiled and cached on a miss."""
+    key = vocabulary_key(vocabulary_path, tokenizer, text_encoder_name)
+    name = os.path.splitext(os.path.basename(vocabulary_path))[0]
+    path = os.path.join(cache_dir, f"{name}_{key}.pt")
+    if os.path.isfile(path):
+        return torch.load(path)
+
+    vocabulary = compile_attribute_vocabulary(vocabulary_path, tokenizer, token_table)
+    vocabulary["key"] = key
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written under a temporary name, a concurrent run never reads half a file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(vocabulary, tmp_path)
+    os.replace(tmp_path, path)
+    return vocabulary
+
+
+def resolve_word_size(vocabulary, word_size):
+    """``word_size`` defaults to the whole vocabulary and may not exceed it."""
+    if word_size is None:
+        return len(vocabulary["words"])
+    if word_size > len(vocabulary["words"]):
+        raise ValueError(
+            f"word_size {word_size} is larger than the"
+            f" {len(vocabulary['words'])} words of {vocabulary['vocabulary_path']}"
+        )
+    return word_size
+
+
+def main():
+    args = parse_args()
+    tokenizer = load_pretrained(
+        CLIPTokenizer, args.pretrained_model_name_or_path, offline=args.offline, subfolder="tokenizer"
+    )
+    text_encoder = load_pretrained(
+        CLIPTextModel, args.pretrained_model_name_or_path, offline=args.offline, subfolder="text_encoder"
+    )
+    vocabulary = load_attribute_vocabulary(
+        args.vocabulary_path,
+        tokenizer,
+        text_encoder.get_input_embeddings().weight,
+        args.vocabulary_cache,
+        args.pretrained_model_name_or_path,
+    )
+    print(
+        f"{len(vocabulary['words'])} words,"
+        f" {sum(len(ids) > 1 for ids in vocabulary['token_ids'])} multi-token (key {vocabulary['key']})"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Automatic micro-batch size and gradient accumulation planning.
+
+``train_batch_size * gradient_accumulation_steps`` is kept as the effective
+batch and the planner picks the largest micro-batch dividing it whose training
+step fits in the memory budget. The step (VAE encode, text encoder, both UNet
+passes and the backward to the token embeddings) is probed on synthetic inputs
+with 1 and 2 samples and its peak memory is extrapolated linearly in the batch
+size. On CUDA the chosen size is probed as well and lowered on out-of-memory
+errors. On CPU, where running out of RAM gets the process killed instead of
+raising, only the extrapolation is used.
+"""
+import torch
+import torch.nn.functional as F
+
+from memory_utils import available_memory_mb, measure_peak_memory_mb
+
+# Fraction of the budget the estimated peak may use
+MEMORY_MARGIN = 0.9
+
+
+def probe_training_step(
+    unet,
+    vae,
+    text_encoder,
+    noise_scheduler,
+    input_ids,
+    batch_size,
+    resolution,
+    noise_draws=1,
+    dtype=torch.float32,
+):
+    """
+    One forward and backward pass shaped like a training step, with one UNet
+    pass per tensor of ``input_ids``. The token embeddings are left untouched.
+    """
+    device = unet.device
+    generator = torch.Generator().manual_seed(0)
+    embeddings = text_encoder.get_input_embeddings().weight
+    requires_grad = embeddings.requires_grad
+    embeddings.requires_grad_(True)
+    try:
+        pixel_values = torch.rand(batch_size, 3, resolution, resolution, generator=generator) * 2 - 1
+        latents = vae.encode(pixel_values.to(device, dtype=dtype)).latent_dist.mean * 0.18215
+        latents = latents.repeat(noise_draws, 1, 1, 1)
+        noise = torch.randn(latents.shape, generator=generator).to(device, dtype=dtype)
+        timesteps = torch.randint(
+            0, noise_scheduler.config.num_train_timesteps, (latents.shape[0],), generator=generator
+        ).to(device)
+        noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
+
+        loss = 0
+        for ids in input_ids:
+            ids = ids.reshape(1, -1).repeat(batch_size, 1).to(device)
+            encoder_hidden_states = text_encoder(ids)[0].to(dtype=dtype)
+            encoder_hidden_states = encoder_hidden_states.repeat(noise_draws, 1, 1)
+            model_pred = unet(noisy_latents, timesteps, encoder_hidden_states).sample
+            loss = loss + F.mse_loss(model_pred.float(), noise.float())
+        loss.backward()
+    finally:
+        embeddings.grad = None
+        embeddings.requires_grad_(requires_grad)
+
+
+def _is_out_of_memory(error):
+    return isinstance(error, RuntimeError) and "out of memory" in str(error)
+
+
+def plan_batch_size(probe, effective_batch_size, device, memory_budget_mb=None):
+    """
+    Picks the micro-batch size for ``effective_batch_size`` samples per
+    update. ``probe(batch_size)`` runs one training step. Returns the
+    decision as a dict, raises ``RuntimeError`` when every probed size runs
+    out of memory.
+    """
+    device = torch.device(device)
+    if memory_budget_mb is None:
+        memory_budget_mb = available_memory_mb(device)
+
+    peak_1 = measure_peak_memory_mb(lambda: probe(1), device)
+    peak_2 = measure_peak_memory_mb(lambda: probe(2), device) if effective_batch_size > 1 else peak_1
+    # Measurement noise can hide the growth, assume the worst then
+    per_sample = peak_2 - peak_1 if peak_2 > peak_1 else peak_1
+    fixed = max(peak_1 - per_sample, 0.0)
+
+    candidates = [
+        b for b in range(effective_batch_size, 0, -1)
+        if effective_batch_size % b == 0
+        and fixed + per_sample * b <= MEMORY_MARGIN * memory_budget_mb
+    ] or [1]
+
+    micro_batch_size = candidates[-1]
+    probed = []
+    if device.type == "cuda":
+        for b in candidates:
+            try:
+                measured = measure_peak_memory_mb(lambda: probe(b), device)
+            except RuntimeError as e:
+                if not _is_out_of_memory(e):
+                    raise
+                torch.cuda.empty_cache()
+                probed.append({"batch_size": b, "peak_memory_mb": None})
+                continue
+            probed.append({"batch_size": b, "peak_memory_mb": measured})
+            micro_batch_size = b
+            break
+        else:
+            raise RuntimeError(
+                f"No micro-batch size of {effective_batch_size} samples per update fits on"
+                f" {device}, every probe of {[p['batch_size'] for p in probed]} ran out of memory"
+            )
+    else:
+        micro_batch_size = candidates[0]
+
+    return {
+        "micro_batch_size": micro_batch_size,
+        "gradient_accumulation_steps": effective_batch_size // micro_batch_size,
+        "effective_batch_size": effective_batch_size,
+        "memory_budget_mb": memory_budget_mb,
+        "fixed_memory_mb": fixed,
+        "per_sample_memory_mb": per_sample,
+        "estimated_peak_memory_mb": fixed + per_sample * micro_batch_size,
+        "fits": fixed + per_sample * micro_batch_size <= MEMORY_MARGIN * memory_budget_mb,
+        "probed": probed,
+    }
@@ -0,0 +1,124 @@
+"""
+Memory/latency benchmark and numerical-equivalence check of the attention
+backends of attention.py.
+
+Every backend runs a training-like UNet pass (forward and backward to the
+text conditioning) and an inference forward on the same random inputs. Its
+outputs and gradients are compared to the ones of the default diffusers
+processor.
+
+    python benchmarks/attention.py --backends sliced chunked xformers --resolution 512
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+from diffusers import UNet2DConditionModel
+
+from utils import ROOT
+
+sys.path.insert(0, ROOT)
+from attention import AttnProcessor, set_attention_backend  # noqa: E402
+from memory_utils import peak_memory_stats, reset_peak_memory_stats  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Attention backend benchmark.")
+    parser.add_argument('--pretrained_model_name_or_path', type=str, default="stabilityai/stable-diffusion-2-1-base", help='The name or path of the pretrained model.')
+    parser.add_argument('--backends', type=str, nargs='+', default=['sliced', 'chunked'], help='Backends to compare with the default processor.')
+    parser.add_argument('--resolution', type=int, default=512, help='Image resolution, the latents are 8 times smaller.')
+    parser.add_argument('--batch_size', type=int, default=2, help='UNet batch size.')
+    parser.add_argument('--attention_slice_size', type=int, default=None, help='Slice size of the sliced backend.')
+    parser.add_argument('--attention_chunk_size', type=int, default=1024, help='Chunk size of the chunked backend.')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed repetitions per backend.')
+    parser.add_argument('--atol', type=float, default=1e-3, help='Absolute tolerance of the equivalence check.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/attention', help='Where results are written.')
+    return parser.parse_args()
+
+
+def run_backend(unet, latents, timesteps, encoder_hidden_states, repeats):
+    device = latents.device
+    times = {"train": [], "inference": []}
+    reset_peak_memory_stats(device)
+    for _ in range(repeats):
+        hidden = encoder_hidden_states.detach().requires_grad_(True)
+        start = time.perf_counter()
+        out = unet(latents, timesteps, hidden).sample
+        out.float().pow(2).mean().backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        times["train"].append(time.perf_counter() - start)
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            unet(latents, timesteps, encoder_hidden_states)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            times["inference"].append(time.perf_counter() - start)
+
+    stats = {
+        "train_step_time": min(times["train"]),
+        "inference_time": min(times["inference"]),
+    }
+    stats.update(peak_memory_stats(device))
+    return out.detach().float(), hidden.grad.detach().float(), stats
+
+
+def main():
+    args = parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    unet = UNet2DConditionModel.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="unet"
+    ).to(device)
+    unet.requires_grad_(False)
+
+    generator = torch.Generator().manual_seed(0)
+    size = args.resolution // 8
+    latents = torch.randn(
+        args.batch_size, unet.config.in_channels, size, size, generator=generator
+    ).to(device)
+    encoder_hidden_states = torch.randn(
+        args.batch_size, 77, unet.config.cross_attention_dim, generator=generator
+    ).to(device)
+    timesteps = torch.randint(0, 1000, (args.batch_size,), generator=generator).to(device)
+
+    unet.set_attn_processor(AttnProcessor())
+    ref_out, ref_grad, ref_stats = run_backend(
+        unet, latents, timesteps, encoder_hidden_states, args.repeats
+    )
+    results = {"default": ref_stats}
+    print("default", json.dumps(ref_stats))
+
+    for backend in args.backends:
+        unet.set_attn_processor(AttnProcessor())
+        set_attention_backend(
+            unet,
+            backend,
+            slice_size=args.attention_slice_size,
+            chunk_size=args.attention_chunk_size,
+        )
+        out, grad, stats = run_backend(
+            unet, latents, timesteps, encoder_hidden_states, args.repeats
+        )
+        stats["max_output_diff"] = (out - ref_out).abs().max().item()
+        stats["max_grad_diff"] = (grad - ref_grad).abs().max().item()
+        stats["equivalent"] = (
+            torch.allclose(out, ref_out, atol=args.atol)
+            and torch.allclose(grad, ref_grad, atol=args.atol, rtol=1e-2)
+        )
+        results[backend] = stats
+        print(backend, json.dumps(stats))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+    if not all(stats.get("equivalent", True) for stats in results.values()):
+        raise SystemExit("Some backends differ from the default processor")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compares --compact_context with the default 77-token padding.
+
+step1 and step2 are run in both modes. Reports the mean step times, the final
+losses and how much the decompositions agree: the overlap of the top
+attribute and object words of the compact run with the ones of the padded
+run. The images generated by step2 are kept in the output directory of each
+mode for a visual or CLIP-score comparison.
+
+    python benchmarks/compact_context.py --concept image/time/ancient_statue/0 \
+        --vocabulary_path image/time/attr.txt
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from utils import run_training
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compact context benchmark.")
+    parser.add_argument('--concept', type=str, required=True, help='Concept image directory.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/compact_context', help='Where runs and results are written.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def overlap(a, b):
+    return len(set(a) & set(b)) / max(len(set(a) | set(b)), 1)
+
+
+def main():
+    args, train_args = parse_args()
+    saved = {}
+    for mode, extra in [("padded", []), ("compact", ["--compact_context"])]:
+        output_dir = os.path.join(args.output_dir, mode)
+        step1 = run_training(1, args.concept, output_dir, train_args, extra)
+        step2 = run_training(
+            2,
+            args.concept,
+            output_dir,
+            train_args,
+            extra + ["--saved_params", f"{output_dir}/step1_params.pt"],
+        )
+        saved[mode] = {1: step1, 2: step2}
+
+    results = {}
+    for mode in saved:
+        row = {}
+        for stage in [1, 2]:
+            params = saved[mode][stage]
+            reference = saved["padded"][stage]
+            # The first step includes one-off warm up costs
+            row[f"step{stage}_mean_step_time"] = float(np.mean(params["step_times"][1:]))
+            row[f"step{stage}_final_loss"] = params["loss_history"][-1]
+            row[f"step{stage}_attribute_overlap"] = overlap(
+                params["top_attributes"], reference["top_attributes"]
+            )
+            row[f"step{stage}_object_overlap"] = overlap(
+                params["top_objects"], reference["top_objects"]
+            )
+        row["top_attributes"] = saved[mode][2]["top_attributes"]
+        results[mode] = row
+        print(mode, json.dumps(row))
+
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
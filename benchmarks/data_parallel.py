@@ -0,0 +1,86 @@
+"""
+Data parallel scaling and consistency check.
+
+Runs step1 (and optionally step2 on its result) with 1..N processes through
+torchrun. Without a GPU the processes use the gloo backend on CPU. Reports the
+throughput (samples/s over all processes) relative to one process, and
+whether the learned networks and placeholder embeddings ended up identical on
+every rank.
+
+    python benchmarks/data_parallel.py --concept image/time/ancient_statue/0 \
+        --num_processes 1 2 --train_batch_size 2 --vocabulary_path image/time/attr.txt
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from utils import run_training
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Data parallel benchmark.")
+    parser.add_argument('--concept', type=str, required=True, help='Concept image directory.')
+    parser.add_argument('--num_processes', type=int, nargs='+', default=[1, 2], help='Process counts to compare.')
+    parser.add_argument('--train_batch_size', type=int, default=6, help='Per-process batch size.')
+    parser.add_argument('--with_step2', action='store_true', help='Also run step2 on the result of step1.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/data_parallel', help='Where runs and results are written.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def summarize(saved, num_processes, batch_size):
+    # The first step includes one-off warm up costs
+    step_time = float(np.mean(saved["step_times"][1:]))
+    return {
+        "num_processes": saved["num_processes"],
+        "mean_step_time": step_time,
+        "samples_per_second": num_processes * batch_size / step_time,
+        "processes_in_sync": saved["processes_in_sync"],
+        "final_loss": saved["loss_history"][-1],
+    }
+
+
+def main():
+    args, train_args = parse_args()
+    train_args = train_args + ["--train_batch_size", str(args.train_batch_size)]
+    results = []
+    for num_processes in args.num_processes:
+        output_dir = os.path.join(args.output_dir, f"np{num_processes}")
+        row = {"step1": summarize(
+            run_training(1, args.concept, output_dir, train_args, num_processes=num_processes),
+            num_processes,
+            args.train_batch_size,
+        )}
+        if args.with_step2:
+            row["step2"] = summarize(
+                run_training(
+                    2,
+                    args.concept,
+                    output_dir,
+                    train_args,
+                    ["--saved_params", f"{output_dir}/step1_params.pt"],
+                    num_processes=num_processes,
+                ),
+                num_processes,
+                args.train_batch_size,
+            )
+        results.append(row)
+
+    for row in results:
+        for stage, stats in row.items():
+            baseline = results[0][stage]["samples_per_second"]
+            stats["scaling"] = stats["samples_per_second"] / baseline
+            print(stage, json.dumps(stats))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+    if not all(stats["processes_in_sync"] for row in results for stats in row.values()):
+        raise SystemExit("Processes ended up with different parameters")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Peak memory and step time of step1 with and without --gradient_checkpointing.
+
+    python benchmarks/gradient_checkpointing.py --concept image/time/ancient_statue/0 \
+        --batch_sizes 6 12 --resolutions 512 768 --max_train_steps 5 \
+        --vocabulary_path image/time/attr.txt
+"""
+import argparse
+import json
+import os
+import subprocess
+
+import numpy as np
+
+from utils import run_training
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Gradient checkpointing benchmark.")
+    parser.add_argument('--concept', type=str, required=True, help='Concept image directory.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[6], help='Values of --train_batch_size to try.')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[512], help='Values of --resolution to try.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/gradient_checkpointing', help='Where runs and results are written.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def main():
+    args, train_args = parse_args()
+    results = []
+    for resolution in args.resolutions:
+        for batch_size in args.batch_sizes:
+            for checkpointing in [False, True]:
+                name = f"r{resolution}_b{batch_size}_{'ckpt' if checkpointing else 'full'}"
+                extra = ["--resolution", str(resolution), "--train_batch_size", str(batch_size)]
+                if checkpointing:
+                    extra.append("--gradient_checkpointing")
+                row = {
+                    "resolution": resolution,
+                    "train_batch_size": batch_size,
+                    "gradient_checkpointing": checkpointing,
+                }
+                try:
+                    saved = run_training(
+                        1, args.concept, os.path.join(args.output_dir, name), train_args, extra
+                    )
+                except subprocess.CalledProcessError:
+                    # Most likely out of memory
+                    row["failed"] = True
+                else:
+                    # The first step includes one-off warm up costs
+                    row["mean_step_time"] = float(np.mean(saved["step_times"][1:]))
+                    row.update(saved["peak_memory"])
+                results.append(row)
+                print(json.dumps(row))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
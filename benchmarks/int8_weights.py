@@ -0,0 +1,179 @@
+"""
+Memory, CPU step time and decomposition quality of --int8_weights.
+
+First, the frozen models are loaded in fp32 and a training step (text
+encoder and the two UNet forwards of the attribute and object prompts,
+backward to a placeholder vector) and a VAE decode are timed; the same is
+done after quantize_frozen_models. The step peak memory of both is reported
+side by side, and the int8 outputs and placeholder gradients are compared to
+the fp32 ones.
+
+With --concept, step1 is also run with and without --int8_weights, and the
+int8 decomposition (placeholder embeddings, top words, final loss) is
+compared to the fp32 one. Unknown arguments are passed to train_step1.py.
+
+    CUDA_VISIBLE_DEVICES= python benchmarks/int8_weights.py --concept image/time/ancient_statue/0 \
+        --max_train_steps 20 --vocabulary_path image/time/attr.txt
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from diffusers import AutoencoderKL, UNet2DConditionModel
+from transformers import CLIPTextModel, CLIPTokenizer
+
+from utils import ROOT, drift, run_training
+
+sys.path.insert(0, ROOT)
+from memory_utils import measure_peak_memory_mb  # noqa: E402
+from quantization import model_size_mb, quantize_frozen_models  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Int8 weight-only quantization benchmark.")
+    parser.add_argument('--pretrained_model_name_or_path', type=str, default="stabilityai/stable-diffusion-2-1-base", help='The name or path of the pretrained model.')
+    parser.add_argument('--resolution', type=int, default=512, help='Image resolution of the timed step, the latents are 8 times smaller.')
+    parser.add_argument('--batch_size', type=int, default=1, help='Latents per timed step.')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed repetitions.')
+    parser.add_argument('--concept', type=str, default=None, help='Concept image directory, runs step1 with and without --int8_weights.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/int8_weights', help='Where runs and results are written.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def training_step(unet, text_encoder, input_ids, input_ids_obj, token_id, vector, latents, timesteps):
+    """
+    Predictions and placeholder gradient of one step. As in the training loop,
+    both UNet passes are alive when the backward starts.
+    """
+    weight = text_encoder.get_input_embeddings().weight
+    weight.detach_().requires_grad_(False)
+    weight[token_id] = vector
+    states = text_encoder(input_ids)[0]
+    states_obj = text_encoder(input_ids_obj)[0]
+    pred = unet(latents, timesteps, states).sample
+    pred_obj = unet(latents, timesteps, states_obj).sample
+    loss = pred.float().pow(2).mean() + pred_obj.float().pow(2).mean()
+    grad, = torch.autograd.grad(loss, vector)
+    return torch.cat([pred.detach(), pred_obj.detach()]), grad
+
+
+def time_fn(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def measure(models, inputs, repeats):
+    unet, text_encoder, vae = models["unet"], models["text_encoder"], models["vae"]
+    outputs = {}
+
+    def step():
+        outputs["pred"], outputs["grad"] = training_step(unet, text_encoder, **inputs["step"])
+
+    def decode():
+        with torch.no_grad():
+            outputs["image"] = vae.decode(inputs["latents"]).sample
+
+    device = inputs["latents"].device
+    stats = {
+        "size_mb": {name: model_size_mb(model) for name, model in models.items()},
+        "step_peak_memory_mb": measure_peak_memory_mb(step, device),
+        "step_time": time_fn(step, repeats),
+        "decode_peak_memory_mb": measure_peak_memory_mb(decode, device),
+        "decode_time": time_fn(decode, repeats),
+    }
+    return outputs, stats
+
+
+def relative_error(x, reference):
+    return ((x.float() - reference.float()).norm() / reference.float().norm()).item()
+
+
+def main():
+    args, train_args = parse_args()
+    name = args.pretrained_model_name_or_path
+    models = {
+        "unet": UNet2DConditionModel.from_pretrained(name, subfolder="unet"),
+        "text_encoder": CLIPTextModel.from_pretrained(name, subfolder="text_encoder"),
+        "vae": AutoencoderKL.from_pretrained(name, subfolder="vae"),
+    }
+    for model in models.values():
+        model.requires_grad_(False)
+    tokenizer = CLIPTokenizer.from_pretrained(name, subfolder="tokenizer")
+
+    generator = torch.Generator().manual_seed(0)
+    token_id = tokenizer.convert_tokens_to_ids("statue</w>")
+    input_ids, input_ids_obj = [
+        tokenizer(
+            [prompt] * args.batch_size,
+            padding="max_length",
+            max_length=tokenizer.model_max_length,
+            return_tensors="pt",
+        ).input_ids
+        for prompt in ["a photo of an ancient statue", "a photo of a statue"]
+    ]
+    latent_size = args.resolution // 8
+    latents = torch.randn(
+        args.batch_size, models["unet"].config.in_channels, latent_size, latent_size, generator=generator
+    )
+    vector = models["text_encoder"].get_input_embeddings().weight[token_id].clone().requires_grad_(True)
+    inputs = {
+        "step": {
+            "input_ids": input_ids,
+            "input_ids_obj": input_ids_obj,
+            "token_id": token_id,
+            "vector": vector,
+            "latents": latents,
+            "timesteps": torch.randint(0, 1000, (args.batch_size,), generator=generator),
+        },
+        "latents": latents,
+    }
+
+    reference, fp32 = measure(models, inputs, args.repeats)
+    print("fp32", json.dumps(fp32))
+    quantization = quantize_frozen_models(models)
+    outputs, int8 = measure(models, inputs, args.repeats)
+    int8["pred_relative_error"] = relative_error(outputs["pred"], reference["pred"])
+    int8["grad_cosine"] = torch.cosine_similarity(outputs["grad"], reference["grad"], dim=0).item()
+    int8["image_max_diff"] = (outputs["image"] - reference["image"]).abs().max().item()
+    int8["step_speedup"] = fp32["step_time"] / int8["step_time"]
+    int8["step_memory_saved_mb"] = fp32["step_peak_memory_mb"] - int8["step_peak_memory_mb"]
+    print("int8", json.dumps(int8))
+    print(f"step peak memory: fp32 {fp32['step_peak_memory_mb']:.0f}MB, int8 {int8['step_peak_memory_mb']:.0f}MB")
+    results = {
+        "config": vars(args),
+        "quantization": quantization,
+        "step_peak_memory_mb": {"fp32": fp32["step_peak_memory_mb"], "int8": int8["step_peak_memory_mb"]},
+        "fp32": fp32,
+        "int8": int8,
+    }
+
+    if args.concept is not None:
+        # The whole of step1, with and without quantization
+        del models, reference, outputs
+        runs = {}
+        for mode, extra in [("fp32", []), ("int8", ["--int8_weights"])]:
+            saved = run_training(
+                1, args.concept, os.path.join(args.output_dir, mode), train_args, extra
+            )
+            runs[mode] = saved
+            results[f"step1_{mode}"] = {
+                "mean_step_time": float(np.mean(saved["step_times"][1:])),
+                **saved["peak_memory"],
+            }
+        results["decomposition_drift"] = drift(runs["int8"], runs["fp32"])
+        print(json.dumps(results["decomposition_drift"]))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Step time, peak memory and embedding drift of step1 in reduced precision.
+
+Runs step1 with --mixed_precision no, then with every precision of
+--precisions, with the same seed. The reduced precision runs are compared to
+the fp32 run: speedup, memory saved, cosine similarity and relative distance
+of the fp32 master placeholder embeddings, and overlap of the top words.
+
+    python benchmarks/mixed_precision.py --concept image/time/ancient_statue/0 \
+        --precisions fp16 bf16 --max_train_steps 20 --vocabulary_path image/time/attr.txt
+"""
+import argparse
+import json
+import os
+import subprocess
+
+import numpy as np
+
+from utils import drift, run_training
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mixed precision benchmark.")
+    parser.add_argument('--concept', type=str, required=True, help='Concept image directory.')
+    parser.add_argument('--precisions', type=str, nargs='+', default=["fp16", "bf16"], choices=["fp16", "bf16"], help='Values of --mixed_precision compared to fp32.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/mixed_precision', help='Where runs and results are written.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def main():
+    args, train_args = parse_args()
+    results = []
+    reference = None
+    for precision in ["no"] + args.precisions:
+        row = {"mixed_precision": precision}
+        try:
+            saved = run_training(
+                1,
+                args.concept,
+                os.path.join(args.output_dir, precision),
+                train_args,
+                ["--mixed_precision", precision],
+            )
+        except subprocess.CalledProcessError:
+            # Most likely out of memory, or a precision the device does not support
+            row["failed"] = True
+            results.append(row)
+            print(json.dumps(row))
+            continue
+
+        # The first step includes one-off warm up costs
+        row["mean_step_time"] = float(np.mean(saved["step_times"][1:]))
+        row.update(saved["peak_memory"])
+        if precision == "no":
+            reference = dict(saved, **row)
+        elif reference is not None:
+            row["speedup"] = reference["mean_step_time"] / row["mean_step_time"]
+            for key in ["peak_device_memory_mb", "peak_host_memory_mb"]:
+                if key in row:
+                    row[key.replace("peak_", "saved_")] = reference[key] - row[key]
+            row.update(drift(saved, reference))
+        results.append(row)
+        print(json.dumps(row))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Measures the effect of --noise_draws_per_latent on step time and on the
+variance of the per-step loss estimate.
+
+step1 is trained for every K in --draws and every seed. The variance of the
+loss estimate is measured as the variance of the loss curve around its
+smoothed trend, and reported relative to the first value of --draws next to
+the mean step time.
+
+    python benchmarks/noise_draws.py --concept image/time/ancient_statue/0 \
+        --draws 1 2 4 --vocabulary_path image/time/attr.txt
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from utils import run_training, smooth
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Noise draws per latent benchmark.")
+    parser.add_argument('--concept', type=str, required=True, help='Concept image directory.')
+    parser.add_argument('--draws', type=int, nargs='+', default=[1, 2, 4], help='Values of --noise_draws_per_latent to compare.')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[1000, 1001, 1002], help='Seeds to average over.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/noise_draws', help='Where runs and results are written.')
+    parser.add_argument('--ema', type=float, default=0.8, help='Smoothing factor of the loss trend.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def main():
+    args, train_args = parse_args()
+    results = {}
+    for draws in args.draws:
+        variances, step_times, final_losses = [], [], []
+        for seed in args.seeds:
+            saved = run_training(
+                1,
+                args.concept,
+                os.path.join(args.output_dir, f"k{draws}", str(seed)),
+                train_args,
+                ["--noise_draws_per_latent", str(draws), "--seed", str(seed)],
+            )
+            losses = np.array(saved["loss_history"])
+            variances.append(float(np.var(losses - np.array(smooth(losses, args.ema)))))
+            # The first step includes one-off warm up costs
+            step_times.extend(saved["step_times"][1:])
+            final_losses.append(float(losses[-1]))
+        results[draws] = {
+            "loss_estimate_variance": float(np.mean(variances)),
+            "mean_step_time": float(np.mean(step_times)),
+            "final_loss_std_across_seeds": float(np.std(final_losses)),
+        }
+
+    baseline = results[args.draws[0]]
+    for draws, row in results.items():
+        row["variance_reduction"] = baseline["loss_estimate_variance"] / row["loss_estimate_variance"]
+        row["relative_step_time"] = row["mean_step_time"] / baseline["mean_step_time"]
+        print(f"K={draws}", json.dumps(row))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
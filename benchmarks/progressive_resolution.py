@@ -0,0 +1,81 @@
+"""
+Compares a --resolution_schedule curriculum with fixed full-resolution
+training.
+
+step1 and step2 are run with both settings. Reports the total and mean step
+time at every resolution, the final loss (mean of the last full-resolution
+steps) and the overlap of the top attribute and object words of the
+curriculum run with the ones of the fixed run. The images generated by step2
+are kept in the output directory of each setting.
+
+    python benchmarks/progressive_resolution.py --concept image/time/ancient_statue/0 \
+        --vocabulary_path image/time/attr.txt --schedule 256:100,512
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from utils import run_training
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Progressive resolution benchmark.")
+    parser.add_argument('--concept', type=str, required=True, help='Concept image directory.')
+    parser.add_argument('--schedule', type=str, default='256:100,512', help='Resolution schedule of the curriculum run.')
+    parser.add_argument('--final_steps', type=int, default=20, help='Number of last steps the final loss is averaged over.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/progressive_resolution', help='Where runs and results are written.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def overlap(a, b):
+    return len(set(a) & set(b)) / max(len(set(a) | set(b)), 1)
+
+
+def main():
+    args, train_args = parse_args()
+    saved = {}
+    for mode, extra in [("fixed", []), ("curriculum", ["--resolution_schedule", args.schedule])]:
+        output_dir = os.path.join(args.output_dir, mode)
+        step1 = run_training(1, args.concept, output_dir, train_args, extra)
+        step2 = run_training(
+            2,
+            args.concept,
+            output_dir,
+            train_args,
+            extra + ["--saved_params", f"{output_dir}/step1_params.pt"],
+        )
+        saved[mode] = {1: step1, 2: step2}
+
+    results = {}
+    for mode in saved:
+        row = {}
+        for stage in [1, 2]:
+            params = saved[mode][stage]
+            reference = saved["fixed"][stage]
+            step_times = np.array(params["step_times"])
+            step_resolutions = np.array(params["step_resolutions"])
+            row[f"step{stage}_total_time"] = float(step_times.sum())
+            for size in np.unique(step_resolutions):
+                # The first step includes one-off warm up costs
+                times = step_times[1:][step_resolutions[1:] == size]
+                row[f"step{stage}_mean_step_time_{size}"] = float(times.mean()) if len(times) else None
+            row[f"step{stage}_final_loss"] = float(np.mean(params["loss_history"][-args.final_steps:]))
+            row[f"step{stage}_attribute_overlap"] = overlap(
+                params["top_attributes"], reference["top_attributes"]
+            )
+            row[f"step{stage}_object_overlap"] = overlap(
+                params["top_objects"], reference["top_objects"]
+            )
+        row["top_attributes"] = saved[mode][2]["top_attributes"]
+        results[mode] = row
+        print(mode, json.dumps(row))
+
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compares uniform and loss-aware timestep sampling.
+
+step1 is trained once per sampler and seed. The loss curves (averaged over
+seeds and smoothed) are used to report how many steps each sampler needs to
+reach --target_loss.
+
+    python benchmarks/timestep_sampling.py --concept image/time/ancient_statue/0 \
+        --target_loss 0.15 --seeds 1000 1001 1002 --vocabulary_path image/time/attr.txt
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from utils import run_training, smooth
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Timestep sampling benchmark.")
+    parser.add_argument('--concept', type=str, required=True, help='Concept image directory.')
+    parser.add_argument('--target_loss', type=float, required=True, help='Smoothed loss to reach.')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[1000, 1001, 1002], help='Seeds to average over.')
+    parser.add_argument('--samplers', type=str, nargs='+', default=['uniform', 'loss_aware'], help='Samplers to compare.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/timestep_sampling', help='Where runs and results are written.')
+    parser.add_argument('--ema', type=float, default=0.8, help='Smoothing factor of the loss curve.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def steps_to_target(loss_history, target):
+    for step, value in enumerate(loss_history, start=1):
+        if value <= target:
+            return step
+    return None
+
+
+def main():
+    args, train_args = parse_args()
+    results = {}
+    for sampler in args.samplers:
+        curves = []
+        for seed in args.seeds:
+            output_dir = os.path.join(args.output_dir, sampler, str(seed))
+            saved = run_training(
+                1,
+                args.concept,
+                output_dir,
+                train_args,
+                ["--timestep_sampling", sampler, "--seed", str(seed)],
+            )
+            curves.append(saved["loss_history"])
+
+        length = min(len(c) for c in curves)
+        mean_curve = np.mean([c[:length] for c in curves], axis=0)
+        std_curve = np.std([c[:length] for c in curves], axis=0)
+        per_seed = [steps_to_target(smooth(c, args.ema), args.target_loss) for c in curves]
+        results[sampler] = {
+            "steps_to_target": steps_to_target(smooth(mean_curve, args.ema), args.target_loss),
+            "steps_to_target_per_seed": per_seed,
+            "final_loss": float(mean_curve[-1]),
+            "mean_loss_std_across_seeds": float(std_curve.mean()),
+        }
+        print(sampler, json.dumps(results[sampler]))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
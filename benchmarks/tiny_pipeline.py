@@ -0,0 +1,265 @@
+"""
+CPU benchmark of step1, step2 and the step2 validation on miniature models.
+
+Builds randomly initialized miniature versions of the Stable Diffusion
+components (UNet, VAE, CLIP text encoder and tokenizer), a miniature CLIP
+model for the image encodings, synthetic concept images, an attribute
+vocabulary and a synthetic embedding bank, then runs the unmodified training
+scripts on them on CPU. The time of every phase (data loading, vocabulary
+scoring with --full_vocabulary, embedding composition, VAE encode, text
+encoder, UNet forward, backward, optimizer, embedding restore, checkpoint and
+validation) is read from the
+``step{N}_phase_times.json`` files of the runs and written to
+``results.json``. Absolute times say little about the full-size models,
+changes between two commits do.
+
+    python benchmarks/tiny_pipeline.py --max_train_steps 5
+"""
+import argparse
+import collections
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from diffusers import AutoencoderKL, DDPMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+from PIL import Image
+from transformers import (
+    CLIPConfig,
+    CLIPImageProcessor,
+    CLIPModel,
+    CLIPProcessor,
+    CLIPTextConfig,
+    CLIPTextModel,
+    CLIPTokenizer,
+)
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+from utils import run_training
+
+ATTRIBUTES = [
+    "ancient", "old", "modern", "weathered", "cracked", "polished", "marble",
+    "bronze", "golden", "rusty", "faded", "vintage", "antique", "classic",
+    "broken", "dusty", "shiny", "mossy", "carved", "painted", "worn", "medieval",
+]
+OBJECTS = [
+    "statue", "stone", "column", "temple", "head", "face", "man", "woman",
+    "horse", "lion", "tree", "sky", "wall", "tower", "ruin", "bust",
+    "sculpture", "figure", "warrior", "king", "garden", "city", "bridge",
+    "river", "mountain", "cloud", "church", "palace", "gate", "door", "window",
+    "road", "ship", "boat", "bird", "dog", "cat", "flower", "leaf", "rock",
+    "sand", "sea", "sun", "moon", "star", "forest", "field", "house", "castle",
+    "market", "shirt", "bed", "clothes", "street", "carrot", "bottle", "car",
+]
+# Words of the training and validation prompts
+PROMPT_WORDS = [
+    "a", "photo", "of", "object", "at", "the", "beach", "in", "jungle", "snow",
+    "on", "top", "pink", "fabric", "wooden", "floor", "with", "background",
+    "eiffel", "floating", "water",
+]
+
+TEXT_CONFIG = dict(
+    hidden_size=64,
+    intermediate_size=128,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    max_position_embeddings=77,
+)
+PROJECTION_DIM = 32
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Miniature model CPU benchmark.")
+    parser.add_argument('--max_train_steps', type=int, default=5, help='Training steps of step1 and step2.')
+    parser.add_argument('--train_batch_size', type=int, default=2, help='Batch size for training.')
+    parser.add_argument('--resolution', type=int, default=64, help='Image resolution.')
+    parser.add_argument('--num_images', type=int, default=4, help='Number of synthetic concept images.')
+    parser.add_argument('--vocabulary_size', type=int, default=64, help='Object vocabulary size, at least 50.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic models and data.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/tiny_pipeline', help='Where assets, runs and results are written.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def train_bpe(words):
+    """BPE merges that turn every word into a single token."""
+    segmentations = {w: tuple(w[:-1]) + (w[-1] + "</w>",) for w in words}
+    merges = []
+    while True:
+        counts = collections.Counter(
+            pair for symbols in segmentations.values() for pair in zip(symbols, symbols[1:])
+        )
+        if not counts:
+            return merges
+        pair = min(counts, key=lambda p: (-counts[p], p))
+        merges.append(pair)
+        for word, symbols in segmentations.items():
+            merged, i = [], 0
+            while i < len(symbols):
+                if i + 1 < len(symbols) and (symbols[i], symbols[i + 1]) == pair:
+                    merged.append(symbols[i] + symbols[i + 1])
+                    i += 2
+                else:
+                    merged.append(symbols[i])
+                    i += 1
+            segmentations[word] = tuple(merged)
+
+
+def build_tokenizer(path, words):
+    os.makedirs(path, exist_ok=True)
+    byte_chars = list(bytes_to_unicode().values())
+    merges = train_bpe(words)
+    tokens = (
+        byte_chars
+        + [c + "</w>" for c in byte_chars]
+        + ["".join(pair) for pair in merges]
+        + ["<|startoftext|>", "<|endoftext|>"]
+    )
+    vocab = {token: i for i, token in enumerate(dict.fromkeys(tokens))}
+    with open(os.path.join(path, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(path, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n" + "\n".join(" ".join(pair) for pair in merges) + "\n")
+    return CLIPTokenizer(
+        os.path.join(path, "vocab.json"), os.path.join(path, "merges.txt"), model_max_length=77
+    )
+
+
+def build_assets(path, args):
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    tokenizer = build_tokenizer(os.path.join(path, "bpe"), ATTRIBUTES + OBJECTS + PROMPT_WORDS)
+    text_encoder = CLIPTextModel(
+        CLIPTextConfig(vocab_size=len(tokenizer), projection_dim=PROJECTION_DIM, **TEXT_CONFIG)
+    )
+    unet = UNet2DConditionModel(
+        sample_size=args.resolution // 8,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=TEXT_CONFIG["hidden_size"],
+        attention_head_dim=8,
+    )
+    # Four blocks, so that the latents are 8 times smaller like in Stable Diffusion
+    vae = AutoencoderKL(
+        block_out_channels=(32, 32, 32, 32),
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        sample_size=args.resolution,
+    )
+    scheduler = DDPMScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", num_train_timesteps=1000
+    )
+    StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    ).save_pretrained(os.path.join(path, "sd"))
+
+    clip_path = os.path.join(path, "clip")
+    CLIPModel(
+        CLIPConfig(
+            text_config=dict(vocab_size=len(tokenizer), **TEXT_CONFIG),
+            vision_config=dict(TEXT_CONFIG, image_size=32, patch_size=8),
+            projection_dim=PROJECTION_DIM,
+        )
+    ).save_pretrained(clip_path)
+    CLIPProcessor(
+        image_processor=CLIPImageProcessor(
+            size={"shortest_edge": 32}, crop_size={"height": 32, "width": 32}
+        ),
+        tokenizer=tokenizer,
+    ).save_pretrained(clip_path)
+
+    vocabulary_path = os.path.join(path, "attr.txt")
+    with open(vocabulary_path, "w") as f:
+        f.write("\n".join(ATTRIBUTES) + "\n")
+
+    # One normalized CLIP text feature per token, like save_dictionary_embeddings.py
+    bank = torch.randn(len(tokenizer), PROJECTION_DIM)
+    bank /= bank.norm(dim=-1, keepdim=True)
+    bank_path = os.path.join(path, "clip_text_encoding.pt")
+    torch.save(bank, bank_path)
+
+    image_dir = os.path.join(path, "images")
+    os.makedirs(image_dir, exist_ok=True)
+    for i in range(args.num_images):
+        colors = rng.integers(0, 256, size=(4, 4, 3), dtype=np.uint8)
+        image = Image.fromarray(colors).resize((96, 96), resample=Image.BICUBIC)
+        image.save(os.path.join(image_dir, f"{i}.jpg"))
+
+    return {
+        "pretrained_model_name_or_path": os.path.join(path, "sd"),
+        "clip_model": clip_path,
+        "path_to_encoder_embeddings": bank_path,
+        "vocabulary_path": vocabulary_path,
+        "vocabulary_cache": os.path.join(path, "vocabulary_cache"),
+        "image_dir": image_dir,
+    }
+
+
+def summarize(params, phase_times_path, wall_time):
+    with open(phase_times_path) as f:
+        phases = json.load(f)["summary"]
+    step_times = params["step_times"]
+    return {
+        "wall_time": wall_time,
+        "num_steps": len(step_times),
+        "total_step_time": float(np.sum(step_times)),
+        # The first step includes one-off warm up costs
+        "mean_step_time": float(np.mean(step_times[1:] or step_times)),
+        "phase_total": phases["total"],
+        "phase_mean_per_step": phases["mean_per_step"],
+        "final_loss": params["loss_history"][-1],
+    }
+
+
+def main():
+    args, train_args = parse_args()
+    # CPU only, whatever the machine has
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+    assets = build_assets(os.path.join(args.output_dir, "assets"), args)
+    run_dir = os.path.join(args.output_dir, "run")
+    common = [
+        "--pretrained_model_name_or_path", assets["pretrained_model_name_or_path"],
+        "--clip_model", assets["clip_model"],
+        "--path_to_encoder_embeddings", assets["path_to_encoder_embeddings"],
+        "--vocabulary_path", assets["vocabulary_path"],
+        "--vocabulary_cache", assets["vocabulary_cache"],
+        "--vocabulary_size", str(args.vocabulary_size),
+        "--num_explanation_tokens", "10",
+        "--num_attr_take", "5",
+        "--resolution", str(args.resolution),
+        "--train_batch_size", str(args.train_batch_size),
+        "--max_train_steps", str(args.max_train_steps),
+        "--validation_steps", str(args.max_train_steps),
+        "--repeats", "10",
+        "--seed", str(args.seed),
+    ] + train_args
+
+    results = {"config": vars(args), "torch_version": torch.__version__}
+    for step in [1, 2]:
+        extra = ["--saved_params", f"{run_dir}/step1_params.pt"] if step == 2 else []
+        start = time.perf_counter()
+        params = run_training(step, assets["image_dir"], run_dir, common, extra)
+        results[f"step{step}"] = summarize(
+            params, f"{run_dir}/step{step}_phase_times.json", time.perf_counter() - start
+        )
+        print(f"step{step}", json.dumps(results[f"step{step}"]))
+
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
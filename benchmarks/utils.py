@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def smooth(values, ema):
+    smoothed, running = [], None
+    for v in values:
+        running = v if running is None else ema * running + (1 - ema) * v
+        smoothed.append(running)
+    return smoothed
+
+
+def run_training(step, concept, output_dir, train_args, extra_args=(), num_processes=1):
+    """
+    Runs train_step{step}.py as a subprocess (with torchrun when
+    ``num_processes`` > 1) and returns its saved params, which include the
+    loss history.
+    """
+    launcher = [sys.executable]
+    if num_processes > 1:
+        launcher += [
+            "-m", "torch.distributed.run", "--standalone",
+            f"--nproc_per_node={num_processes}",
+        ]
+    cmd = launcher + [
+        os.path.join(ROOT, f"train_step{step}.py"),
+        "--train_data_dir", concept,
+        "--output_dir", output_dir,
+    ] + list(train_args) + list(extra_args)
+    subprocess.run(cmd, check=True)
+    return torch.load(f"{output_dir}/step{step}_params.pt", map_location="cpu")
+
+
+def overlap(a, b):
+    return len(set(a) & set(b)) / max(len(a), 1)
+
+
+def drift(saved, reference):
+    """
+    How far the placeholder embeddings, top words and final loss of the saved
+    params ``saved`` are from those of ``reference``.
+    """
+    row = {}
+    for name, embedding in saved["placeholder_embeddings"].items():
+        ref = reference["placeholder_embeddings"][name]
+        row[f"{name}_cosine"] = torch.cosine_similarity(embedding, ref, dim=0).item()
+        row[f"{name}_relative_distance"] = ((embedding - ref).norm() / ref.norm()).item()
+    row["top_objects_overlap"] = overlap(saved["top_objects"], reference["top_objects"])
+    row["top_attributes_overlap"] = overlap(saved["top_attributes"], reference["top_attributes"])
+    row["final_loss_difference"] = abs(saved["loss_history"][-1] - reference["loss_history"][-1])
+    return row
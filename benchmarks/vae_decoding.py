@@ -0,0 +1,114 @@
+"""
+Peak memory and throughput of the VAE decoding modes of vae_decoding.py
+across resolutions.
+
+For every resolution, a batch of random latents is decoded all at once (the
+pipeline default), one image at a time, tiled, and tiled one image at a
+time. Modes that run out of memory are reported as such. The tiled outputs
+are compared to the full decode when it fits, tiling changes the result a
+little since the decoder normalizes and attends over each tile alone.
+
+    python benchmarks/vae_decoding.py --resolutions 512 768 1024 1536 --batch_size 4
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+from diffusers import AutoencoderKL
+
+from utils import ROOT
+
+sys.path.insert(0, ROOT)
+from batch_planner import _is_out_of_memory  # noqa: E402
+from memory_utils import measure_peak_memory_mb  # noqa: E402
+from vae_decoding import DEFAULT_OVERLAP, DEFAULT_TILE_SIZE, decode_latents  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="VAE decoding benchmark.")
+    parser.add_argument('--pretrained_model_name_or_path', type=str, default="stabilityai/stable-diffusion-2-1-base", help='The name or path of the pretrained model.')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[512, 768, 1024], help='Image resolutions, the latents are 8 times smaller.')
+    parser.add_argument('--batch_size', type=int, default=4, help='Number of images decoded per call.')
+    parser.add_argument('--tile_size', type=int, default=DEFAULT_TILE_SIZE, help='Tile size in latent pixels.')
+    parser.add_argument('--overlap', type=int, default=DEFAULT_OVERLAP, help='Tile overlap in latent pixels.')
+    parser.add_argument('--repeats', type=int, default=2, help='Timed repetitions per mode.')
+    parser.add_argument('--fp16', action='store_true', help='Decode in float16.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/vae_decoding', help='Where results are written.')
+    return parser.parse_args()
+
+
+def run_mode(vae, latents, repeats, **kwargs):
+    device = latents.device
+    outputs = []
+
+    def decode():
+        images = decode_latents(vae, latents, **kwargs)
+        if not outputs:
+            outputs.append(images)
+
+    try:
+        with torch.no_grad():
+            peak = measure_peak_memory_mb(decode, device)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                decode()
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+            elapsed = (time.perf_counter() - start) / repeats
+    except RuntimeError as e:
+        if not _is_out_of_memory(e):
+            raise
+        torch.cuda.empty_cache()
+        return None, {"out_of_memory": True}
+    return outputs[0].float(), {
+        "peak_memory_mb": peak,
+        "time": elapsed,
+        "images_per_second": len(latents) / elapsed,
+    }
+
+
+def main():
+    args = parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.float16 if args.fp16 else torch.float32
+    vae = AutoencoderKL.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="vae"
+    ).to(device, dtype=dtype)
+    vae.requires_grad_(False)
+
+    modes = {
+        "full": {},
+        "sequential": {"batch_size": 1},
+        "tiled": {"tile_size": args.tile_size, "overlap": args.overlap},
+        "tiled_sequential": {"tile_size": args.tile_size, "overlap": args.overlap, "batch_size": 1},
+    }
+    results = {"config": vars(args), "device": str(device)}
+    for resolution in args.resolutions:
+        generator = torch.Generator().manual_seed(0)
+        latents = torch.randn(
+            args.batch_size, vae.config.latent_channels, resolution // 8, resolution // 8,
+            generator=generator,
+        ).to(device, dtype=dtype)
+        results[resolution] = {}
+        reference = None
+        for name, kwargs in modes.items():
+            images, stats = run_mode(vae, latents, args.repeats, **kwargs)
+            if name == "full":
+                reference = images
+            elif images is not None and reference is not None:
+                stats["max_diff_to_full"] = (images - reference).abs().max().item()
+                stats["mean_diff_to_full"] = (images - reference).abs().mean().item()
+            results[resolution][name] = stats
+            print(resolution, name, json.dumps(stats))
+            del images
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
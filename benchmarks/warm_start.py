@@ -0,0 +1,70 @@
+"""
+Compares step1 warm-started from a concept library against cold starts.
+
+For every concept directory, step1 is run once from random initialization and
+once with --warm_start (leaving the concept itself out of the library). The
+loss history saved in step1_params.pt is used to report the final loss and the
+number of steps needed to get within --tolerance of it.
+
+    python benchmarks/warm_start.py --concepts image/time/a/0 image/time/b/0 \
+        --concept_library library --vocabulary_path image/time/attr.txt
+"""
+import argparse
+import json
+import os
+
+from utils import run_training, smooth
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Warm start benchmark.")
+    parser.add_argument('--concepts', type=str, nargs='+', required=True, help='Concept image directories to benchmark.')
+    parser.add_argument('--concept_library', type=str, required=True, help='Library of previously decomposed concepts.')
+    parser.add_argument('--output_dir', type=str, default='bench_output/warm_start', help='Where runs and results are written.')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='Relative distance to the final loss counted as converged.')
+    parser.add_argument('--ema', type=float, default=0.8, help='Smoothing factor of the loss curve.')
+    args, train_args = parser.parse_known_args()
+    return args, train_args
+
+
+def steps_to_convergence(loss_history, tolerance, ema):
+    smoothed = smooth(loss_history, ema)
+    final = smoothed[-1]
+    for step, value in enumerate(smoothed, start=1):
+        if all(abs(v - final) <= tolerance * abs(final) for v in smoothed[step - 1:]):
+            return step
+    return len(smoothed)
+
+
+def main():
+    args, train_args = parse_args()
+    results = []
+    for concept in args.concepts:
+        name = os.path.basename(os.path.normpath(concept))
+        row = {"concept": concept}
+        for mode, extra in [
+            ("cold", []),
+            ("warm", ["--warm_start", "--concept_library", args.concept_library]),
+        ]:
+            losses = run_training(
+                1, concept, os.path.join(args.output_dir, name, mode), train_args, extra
+            )["loss_history"]
+            row[f"{mode}_final_loss"] = float(sum(losses[-5:]) / len(losses[-5:]))
+            row[f"{mode}_steps_to_convergence"] = steps_to_convergence(
+                losses, args.tolerance, args.ema
+            )
+        results.append(row)
+        print(json.dumps(row))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+
+    for mode in ["cold", "warm"]:
+        mean_steps = sum(r[f"{mode}_steps_to_convergence"] for r in results) / len(results)
+        mean_loss = sum(r[f"{mode}_final_loss"] for r in results) / len(results)
+        print(f"{mode}: steps to convergence {mean_steps:.1f}, final loss {mean_loss:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+CLIP scores of the images generated at the end of step2.
+
+Every directory under ``--outputs_root`` holding ``{l}_prompt_{i}`` folders
+is a concept output (the ``--output_dir`` of a step2 run). Its images are
+scored with CLIP against:
+
+- their prompt (``clip_t``), the ``i``-th validation template of the ``l``-th
+  token of ``--test_prompt`` with the placeholder replaced by the top
+  ``--num_words`` words of the decomposition saved in ``step2_params.pt``,
+- the concept images (``clip_i``), the mean normalized image feature of
+  ``{--train_data_root}/{concept}``, when it exists.
+
+All the images of all the concepts are streamed through one DataLoader, so
+decoding and preprocessing happen in the workers while the device encodes
+``--batch_size`` images at a time. Writes ``clip_scores.csv`` (one row per
+prompt) in every concept output and ``clip_summary.csv`` (one row per
+concept) in ``--outputs_root``.
+
+    python clip_evaluation.py --outputs_root ../output --train_data_root ../image
+"""
+import argparse
+import csv
+import os
+import re
+import time
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+from transformers import CLIPModel, CLIPProcessor
+
+from image_selection import image_features, list_images, load_rgb
+from preview import validation_prompts
+from resources import load_pretrained
+
+PROMPT_DIR = re.compile(r"^(\d+)_prompt_(\d+)$")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CLIP scores of the images generated by step2.")
+    parser.add_argument('--outputs_root', type=str, required=True, help='Directory searched for step2 outputs.')
+    parser.add_argument('--train_data_root', type=str, default=None, help='Directory of the concept images, {train_data_root}/{concept} for the concept output {outputs_root}/{concept}.')
+    parser.add_argument('--clip_model', type=str, default='openai/clip-vit-base-patch32', help='The CLIP model to score with.')
+    parser.add_argument('--test_prompt', type=str, default="<>,[]", help='--test_prompt of the step2 runs.')
+    parser.add_argument('--attr_placeholder_token', type=str, default="<>", help='--attr_placeholder_token of the step2 runs.')
+    parser.add_argument('--obj_placeholder_token', type=str, default="[]", help='--obj_placeholder_token of the step2 runs.')
+    parser.add_argument('--num_words', type=int, default=1, help='Top decomposition words that replace a placeholder in the scored prompts.')
+    parser.add_argument('--batch_size', type=int, default=256, help='Images encoded at once.')
+    parser.add_argument('--num_workers', type=int, default=8, help='DataLoader workers decoding and preprocessing the images.')
+    parser.add_argument('--offline', action='store_true', help='Never download the CLIP model, fail if it is not cached locally.')
+    return parser.parse_args()
+
+
+class ImageFiles(Dataset):
+    def __init__(self, paths, processor):
+        self.paths = paths
+        self.processor = processor
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        pixel_values = self.processor(images=load_rgb(self.paths[i]), return_tensors="pt")["pixel_values"]
+        return pixel_values[0], i
+
+
+def find_concepts(outputs_root):
+    """{concept: {(l, i): [image paths]}} for every concept output under ``outputs_root``."""
+    concepts = {}
+    for dirpath, dirnames, _ in os.walk(outputs_root):
+        prompts = {}
+        for name in dirnames:
+            match = PROMPT_DIR.match(name)
+            if match:
+                prompts[int(match[1]), int(match[2])] = list_images(os.path.join(dirpath, name))
+        if prompts:
+            concepts[os.path.relpath(dirpath, outputs_root)] = dict(sorted(prompts.items()))
+    return dict(sorted(concepts.items()))
+
+
+def concept_prompts(concept_dir, args):
+    """The prompt of every (l, i), with the placeholders replaced by the decomposition."""
+    params_path = os.path.join(concept_dir, "step2_params.pt")
+    if not os.path.isfile(params_path):
+        return None
+    params = torch.load(params_path, map_location="cpu")
+    words = {
+        args.attr_placeholder_token: " ".join(params["top_attributes"][: args.num_words]),
+        args.obj_placeholder_token: " ".join(params["top_objects"][: args.num_words]),
+    }
+    prompts = {}
+    for l, group in enumerate(validation_prompts(args.test_prompt, args.obj_placeholder_token)):
+        for i, prompt in enumerate(group):
+            for token, text in words.items():
+                prompt = prompt.replace(token, text)
+            prompts[l, i] = prompt
+    return prompts
+
+
+def text_features(clip_model, processor, texts, device, batch_size=256):
+    features = []
+    for start in range(0, len(texts), batch_size):
+        inputs = processor(text=texts[start : start + batch_size], return_tensors="pt", padding=True, truncation=True)
+        with torch.no_grad():
+            batch_features = clip_model.get_text_features(
+                input_ids=inputs["input_ids"].to(device),
+                attention_mask=inputs["attention_mask"].to(device),
+            )
+        features.append(batch_features / batch_features.norm(dim=-1, keepdim=True))
+    return torch.cat(features)
+
+
+def encode_image_files(clip_model, processor, paths, device, batch_size=256, num_workers=8):
+    """Normalized CLIP image features of ``paths``, in order."""
+    loader = DataLoader(
+        ImageFiles(paths, processor),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=torch.device(device).type == "cuda",
+    )
+    features = torch.empty(len(paths), clip_model.config.projection_dim)
+    autocast = torch.autocast("cuda", dtype=torch.float16, enabled=torch.device(device).type == "cuda")
+    for pixel_values, indices in loader:
+        with autocast:
+            features[indices] = image_features(clip_model, pixel_values.to(device, non_blocking=True)).float().cpu()
+    return features
+
+
+def evaluate(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    clip_model = load_pretrained(CLIPModel, args.clip_model, offline=args.offline).to(device).eval()
+    processor = load_pretrained(CLIPProcessor, args.clip_model, offline=args.offline)
+
+    concepts = find_concepts(args.outputs_root)
+    # One flat list of every generated and training image, encoded in one stream
+    paths, owners = [], []
+    for concept, prompts in concepts.items():
+        for key, images in prompts.items():
+            paths += images
+            owners += [(concept, key)] * len(images)
+        train_dir = os.path.join(args.train_data_root, concept) if args.train_data_root else None
+        if train_dir is not None and os.path.isdir(train_dir):
+            images = list_images(train_dir)
+            paths += images
+            owners += [(concept, "train")] * len(images)
+
+    start = time.perf_counter()
+    features = encode_image_files(
+        clip_model, processor, paths, device, args.batch_size, args.num_workers
+    )
+    elapsed = time.perf_counter() - start
+    print(f"Encoded {len(paths)} images in {elapsed:.1f}s ({len(paths) / max(elapsed, 1e-9):.0f} images/s)")
+
+    by_owner = {}
+    for row, owner in enumerate(owners):
+        by_owner.setdefault(owner, []).append(row)
+
+    summary = []
+    for concept, prompts in concepts.items():
+        concept_dir = os.path.join(args.outputs_root, concept)
+        texts = concept_prompts(concept_dir, args)
+        prompt_features = {}
+        if texts is not None:
+            # Folders from another --test_prompt have no prompt to score against
+            keys = [k for k in prompts if k in texts]
+            if keys:
+                prompt_features = dict(zip(keys, text_features(clip_model, processor, [texts[k] for k in keys], device).cpu()))
+        train_rows = by_owner.get((concept, "train"))
+        train_feature = None
+        if train_rows:
+            train_feature = features[train_rows].mean(dim=0)
+            train_feature /= train_feature.norm()
+
+        rows = []
+        for (l, i), images in prompts.items():
+            image_rows = by_owner.get((concept, (l, i)), [])
+            row = {
+                "token": l,
+                "prompt": i,
+                "text": texts.get((l, i), "") if texts is not None else "",
+                "num_images": len(image_rows),
+                "clip_t": None,
+                "clip_i": None,
+            }
+            if image_rows and (l, i) in prompt_features:
+                row["clip_t"] = (features[image_rows] @ prompt_features[l, i]).mean().item()
+            if image_rows and train_feature is not None:
+                row["clip_i"] = (features[image_rows] @ train_feature).mean().item()
+            rows.append(row)
+
+        with open(os.path.join(concept_dir, "clip_scores.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+        summary_row = {"concept": concept, "num_images": sum(r["num_images"] for r in rows)}
+        for l in sorted({r["token"] for r in rows}):
+            for metric in ["clip_t", "clip_i"]:
+                values = [r[metric] for r in rows if r["token"] == l and r[metric] is not None]
+                summary_row[f"{metric}_{l}"] = sum(values) / len(values) if values else None
+        summary.append(summary_row)
+
+    if summary:
+        fieldnames = list(dict.fromkeys(k for row in summary for k in row))
+        with open(os.path.join(args.outputs_root, "clip_summary.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(summary)
+    return summary
+
+
+def main():
+    args = parse_args()
+    summary = evaluate(args)
+    for row in summary:
+        print(" | ".join(
+            f"{v:.4f}" if isinstance(v, float) else str(v) for v in row.values()
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Library of previously decomposed concepts, used to warm-start training.
+
+Every entry is a single ``.pt`` file holding the normalized mean CLIP image
+embedding of a concept (from ``get_clip_encodings``) together with the
+``WeightLearningNetwork`` state dicts learned for it.
+"""
+import glob
+import hashlib
+import os
+
+import torch
+
+
+def file_hash(path):
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def mean_image_encoding(target_image_encodings):
+    mean = target_image_encodings.detach().float().mean(dim=0)
+    return (mean / mean.norm()).cpu()
+
+
+def _entry_path(library_dir, data_root):
+    data_root = os.path.abspath(data_root)
+    key = hashlib.sha1(data_root.encode()).hexdigest()[:16]
+    name = os.path.basename(os.path.normpath(data_root))
+    return os.path.join(library_dir, f"{name}_{key}.pt")
+
+
+def add_concept(
+    library_dir,
+    data_root,
+    target_image_encodings,
+    net_attr_state_dict,
+    net_obj_state_dict,
+    vocabulary_path=None,
+    final_loss=None,
+):
+    os.makedirs(library_dir, exist_ok=True)
+    entry = {
+        "data_root": os.path.abspath(data_root),
+        "image_encoding": mean_image_encoding(target_image_encodings),
+        "vocabulary_hash": file_hash(vocabulary_path),
+        "net_attr_state_dict": {
+            k: v.detach().cpu() for k, v in net_attr_state_dict.items()
+        },
+        "net_obj_state_dict": {
+            k: v.detach().cpu() for k, v in net_obj_state_dict.items()
+        },
+        "final_loss": final_loss,
+    }
+    path = _entry_path(library_dir, data_root)
+    torch.save(entry, path)
+    return path
+
+
+def find_nearest_concept(library_dir, target_image_encodings, exclude=None):
+    """
+    Returns the library entry whose mean image embedding is closest (cosine)
+    to the one of ``target_image_encodings``, and its similarity. Entries
+    trained on ``exclude`` are skipped so a concept never warm-starts from
+    itself.
+    """
+    if library_dir is None or not os.path.isdir(library_dir):
+        return None, None
+    exclude = os.path.abspath(exclude) if exclude is not None else None
+    query = mean_image_encoding(target_image_encodings)
+
+    best_entry, best_similarity = None, None
+    for path in sorted(glob.glob(os.path.join(library_dir, "*.pt"))):
+        entry = torch.load(path, map_location="cpu")
+        if exclude is not None and entry["data_root"] == exclude:
+            continue
+        similarity = torch.dot(query, entry["image_encoding"]).item()
+        if best_similarity is None or similarity > best_similarity:
+            best_entry, best_similarity = entry, similarity
+    return best_entry, best_similarity
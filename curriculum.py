@@ -0,0 +1,52 @@
+"""
+Progressive-resolution training curriculum.
+
+A schedule such as ``256:20,512`` trains the first 20 steps of a stage at
+256px and the remaining ones at 512px. The last resolution of the schedule
+must be the full ``--resolution``.
+"""
+
+
+def parse_resolution_schedule(spec, resolution):
+    """Returns a list of (resolution, last step at that resolution or None)."""
+    if spec is None:
+        return [(resolution, None)]
+
+    schedule = []
+    entries = spec.split(",")
+    for i, entry in enumerate(entries):
+        if ":" in entry:
+            size, until = entry.split(":")
+            schedule.append((int(size), int(until)))
+        elif i == len(entries) - 1:
+            schedule.append((int(entry), None))
+        else:
+            raise ValueError(f"Only the last entry of {spec} may omit its number of steps")
+
+    for size, _ in schedule:
+        if size % 64 != 0:
+            raise ValueError(f"Resolution {size} of {spec} is not a multiple of 64")
+    if schedule[-1][0] != resolution:
+        raise ValueError(f"The schedule {spec} must end at the full resolution {resolution}")
+    schedule[-1] = (resolution, None)
+    return schedule
+
+
+def resolution_at(schedule, step):
+    """Resolution of the (0-based) training step ``step``."""
+    for size, until in schedule:
+        if until is None or step < until:
+            return size
+    return schedule[-1][0]
+
+
+def schedule_sizes(schedule):
+    return sorted({size for size, _ in schedule})
+
+
+def step_time_per_resolution(step_times, step_resolutions):
+    """Mean wall-clock time per step at every resolution."""
+    per_resolution = {}
+    for step_time, size in zip(step_times, step_resolutions):
+        per_resolution.setdefault(size, []).append(step_time)
+    return {size: sum(times) / len(times) for size, times in per_resolution.items()}
@@ -0,0 +1,45 @@
+"""
+Helpers for data parallel training with ``Accelerator``.
+
+The ``WeightLearningNetwork``s are wrapped by ``accelerator.prepare`` and get
+their gradients averaged by DDP. Learned tensors that are not part of a module
+(the step2 placeholder embeddings) are averaged with ``all_reduce_grads``.
+"""
+import torch
+import torch.distributed as dist
+
+
+def all_reduce_grads(accelerator, tensors):
+    if accelerator.num_processes == 1:
+        return
+    for tensor in tensors:
+        if tensor.grad is not None:
+            dist.all_reduce(tensor.grad, op=dist.ReduceOp.SUM)
+            tensor.grad /= accelerator.num_processes
+
+
+def gather_mean(accelerator, value):
+    """Mean of a scalar tensor over all processes, as a float."""
+    value = value.detach().float().reshape(1)
+    if accelerator.num_processes > 1:
+        value = accelerator.gather(value)
+    return value.mean().item()
+
+
+def parameters_in_sync(accelerator, tensors):
+    """Whether ``tensors`` hold exactly the same values on every process."""
+    if accelerator.num_processes == 1:
+        return True
+    flat = torch.cat([t.detach().float().reshape(-1) for t in tensors])
+    positions = torch.arange(1, flat.numel() + 1, device=flat.device, dtype=flat.dtype)
+    checksum = torch.stack([flat.sum(), flat.abs().sum(), (flat * positions).sum()])
+    gathered = accelerator.gather(checksum.reshape(1, -1))
+    return bool((gathered == gathered[0]).all().item())
+
+
+def gather_min(accelerator, value):
+    """Minimum of an integer over all processes."""
+    if accelerator.num_processes == 1:
+        return value
+    value = torch.tensor([value], device=accelerator.device)
+    return int(accelerator.gather(value).min().item())
@@ -0,0 +1,83 @@
+"""
+Convergence-based early stopping for the decomposition stages.
+
+A stage is considered settled once, for ``patience`` consecutive steps, the
+top-k entries of every vocabulary ranking (``sorted_obj``/``sorted_attr``)
+stay the same and the smoothed loss stops moving.
+"""
+from accelerate.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class RankingStabilityStopper:
+    def __init__(
+        self,
+        top_k=10,
+        min_overlap=0.9,
+        loss_tolerance=0.01,
+        ema=0.9,
+        patience=5,
+        min_steps=10,
+    ):
+        self.top_k = top_k
+        self.min_overlap = min_overlap
+        self.loss_tolerance = loss_tolerance
+        self.ema = ema
+        self.patience = patience
+        self.min_steps = min_steps
+
+        self.prev_top = {}
+        self.smoothed_loss = None
+        self.stable_steps = 0
+        self.history = []
+
+    def _overlap(self, name, ranking):
+        top = ranking[: self.top_k].tolist()
+        prev = self.prev_top.get(name)
+        self.prev_top[name] = top
+        if prev is None:
+            return 0.0
+        return len(set(prev) & set(top)) / len(top)
+
+    def update(self, step, rankings, loss):
+        """
+        Records the rankings and loss of ``step`` and returns whether the
+        stage should stop now.
+        """
+        overlaps = {
+            name: self._overlap(name, ranking) for name, ranking in rankings.items()
+        }
+
+        prev_loss = self.smoothed_loss
+        if prev_loss is None:
+            self.smoothed_loss = loss
+            loss_change = float("inf")
+        else:
+            self.smoothed_loss = self.ema * prev_loss + (1 - self.ema) * loss
+            loss_change = abs(self.smoothed_loss - prev_loss) / max(abs(prev_loss), 1e-8)
+
+        stable = (
+            all(o >= self.min_overlap for o in overlaps.values())
+            and loss_change <= self.loss_tolerance
+        )
+        self.stable_steps = self.stable_steps + 1 if stable else 0
+        self.history.append(
+            {
+                "step": step,
+                "overlaps": overlaps,
+                "smoothed_loss": self.smoothed_loss,
+                "loss_change": loss_change,
+                "stable_steps": self.stable_steps,
+            }
+        )
+
+        should_stop = step >= self.min_steps and self.stable_steps >= self.patience
+        if should_stop:
+            overlap_str = ", ".join(f"{k} {v:.2f}" for k, v in overlaps.items())
+            logger.info(
+                f"Early stopping at step {step}: top-{self.top_k} overlap ({overlap_str}),"
+                f" smoothed loss {self.smoothed_loss:.4f} changed by {loss_change:.2%},"
+                f" stable for {self.stable_steps} steps"
+            )
+        return should_stop
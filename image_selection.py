@@ -0,0 +1,111 @@
+"""
+Near-duplicate filtering of the concept images before training.
+
+The CLIP image features of all the images are computed in batches. An image
+whose cosine similarity to an already kept image reaches the threshold joins
+that image's cluster and is dropped. With a cap, the kept images are further
+reduced to a representative subset by farthest point sampling, starting from
+the image closest to the mean. The report says how many images are left and
+how many VAE encodes and UNet passes an epoch costs before and after.
+"""
+import os
+
+import torch
+
+from archive_source import IMAGE_EXTENSIONS, open_image
+
+
+def list_images(data_root):
+    return sorted(
+        os.path.join(data_root, f)
+        for f in os.listdir(data_root)
+        if f.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+def load_rgb(path):
+    image = open_image(path)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+def image_features(clip_model, pixel_values):
+    """Normalized CLIP image features of preprocessed images."""
+    with torch.no_grad():
+        features = clip_model.get_image_features(pixel_values)
+    return features / features.norm(dim=-1, keepdim=True)
+
+
+def encode_images(clip_model, clip_processor, image_paths, device, batch_size=32):
+    """Normalized CLIP image features, ``batch_size`` images at a time."""
+    features = []
+    for start in range(0, len(image_paths), batch_size):
+        images = [load_rgb(path) for path in image_paths[start : start + batch_size]]
+        pixel_values = clip_processor(images=images, return_tensors="pt")["pixel_values"].to(device)
+        features.append(image_features(clip_model, pixel_values))
+    return torch.cat(features)
+
+
+def cluster_near_duplicates(features, threshold):
+    """
+    Indices of the kept images, and for every image the index of the kept
+    image it duplicates (itself if kept).
+    """
+    kept = []
+    duplicate_of = []
+    for i in range(len(features)):
+        if kept:
+            similarities = features[kept] @ features[i]
+            best = int(similarities.argmax())
+            if similarities[best] >= threshold:
+                duplicate_of.append(kept[best])
+                continue
+        kept.append(i)
+        duplicate_of.append(i)
+    return kept, duplicate_of
+
+
+def representative_subset(features, k):
+    """``k`` indices of ``features`` covering them best, in increasing order."""
+    mean = features.mean(dim=0)
+    chosen = [int((features @ mean).argmax())]
+    distances = 1 - features @ features[chosen[0]]
+    while len(chosen) < k:
+        i = int(distances.argmax())
+        chosen.append(i)
+        distances = torch.minimum(distances, 1 - features @ features[i])
+    return sorted(chosen)
+
+
+def select_concept_images(image_paths, features, threshold=None, max_images=None, repeats=1):
+    """Indices of the images to train on and a report of the selection."""
+    features = features.float()
+    keep = list(range(len(image_paths)))
+    duplicate_of = keep
+    if threshold is not None:
+        keep, duplicate_of = cluster_near_duplicates(features, threshold)
+    num_unique = len(keep)
+    if max_images is not None and len(keep) > max_images:
+        subset = representative_subset(features[keep], max_images)
+        keep = [keep[i] for i in subset]
+
+    num_images = len(image_paths)
+    report = {
+        "threshold": threshold,
+        "max_images": max_images,
+        "num_images": num_images,
+        "num_near_duplicates": num_images - num_unique,
+        "num_capped": num_unique - len(keep),
+        "num_kept": len(keep),
+        "kept": [os.path.basename(str(image_paths[i])) for i in keep],
+        "duplicates": {
+            os.path.basename(str(image_paths[i])): os.path.basename(str(image_paths[j]))
+            for i, j in enumerate(duplicate_of)
+            if i != j
+        },
+        # One VAE encode and UNet pass per sample
+        "samples_per_epoch": {"before": num_images * repeats, "after": len(keep) * repeats},
+        "compute_saved": 1 - len(keep) / max(num_images, 1),
+    }
+    return keep, report
@@ -0,0 +1,90 @@
+"""
+Cache of the VAE latent distributions of a concept image set.
+
+``CUSDataset`` only resizes (and optionally center crops) the images and
+flips them at random, so every training latent is a sample of one of two
+distributions per image (original or mirrored). Encoding both once and
+sampling from the cached mean/std is equivalent to encoding every batch.
+The cache can hold the image set at several resolutions.
+"""
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+from archive_source import open_image
+
+
+def load_training_image(image_path, size, interpolation, center_crop=False, mirror=False):
+    image = open_image(image_path)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if mirror:
+        image = ImageOps.mirror(image)
+
+    img = np.array(image).astype(np.uint8)
+    if center_crop:
+        crop = min(img.shape[0], img.shape[1])
+        h, w = img.shape[0], img.shape[1]
+        img = img[(h - crop) // 2 : (h + crop) // 2, (w - crop) // 2 : (w + crop) // 2]
+
+    image = Image.fromarray(img)
+    image = image.resize((size, size), resample=interpolation)
+    image = np.array(image).astype(np.uint8)
+    image = (image / 127.5 - 1.0).astype(np.float32)
+    return torch.from_numpy(image).permute(2, 0, 1)
+
+
+class LatentCache:
+    def __init__(
+        self,
+        vae,
+        image_paths,
+        sizes,
+        interpolation,
+        center_crop=False,
+        batch_size=4,
+        device="cpu",
+        dtype=torch.float32,
+    ):
+        self.image_paths = list(image_paths)
+        if isinstance(sizes, int):
+            sizes = [sizes]
+        self.sizes = list(sizes)
+
+        # size -> [num_images, 2 (original, mirrored), C, h, w]
+        self.mean, self.std = {}, {}
+        for size in self.sizes:
+            pixel_values = torch.stack(
+                [
+                    load_training_image(p, size, interpolation, center_crop, mirror)
+                    for p in self.image_paths
+                    for mirror in (False, True)
+                ]
+            )
+            means, stds = [], []
+            with torch.no_grad():
+                for i in range(0, len(pixel_values), batch_size):
+                    latent_dist = vae.encode(
+                        pixel_values[i : i + batch_size].to(device, dtype=dtype)
+                    ).latent_dist
+                    means.append(latent_dist.mean)
+                    stds.append(latent_dist.std)
+            shape = (len(self.image_paths), 2) + tuple(means[0].shape[1:])
+            self.mean[size] = torch.cat(means).reshape(shape)
+            self.std[size] = torch.cat(stds).reshape(shape)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def sample(self, batch_size, size=None):
+        """
+        Draws scaled latents for ``batch_size`` random images with random
+        horizontal flips, like a batch of ``CUSDataset`` would give.
+        """
+        size = self.sizes[-1] if size is None else size
+        device = self.mean[size].device
+        indices = torch.randint(0, len(self), (batch_size,), device=device)
+        flips = torch.randint(0, 2, (batch_size,), device=device)
+        mean = self.mean[size][indices, flips]
+        std = self.std[size][indices, flips]
+        return (mean + std * torch.randn_like(mean)) * 0.18215
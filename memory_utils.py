@@ -0,0 +1,93 @@
+"""
+Peak memory measurements on the training device and the host.
+"""
+import gc
+import os
+import resource
+import sys
+
+import torch
+
+
+def reset_peak_memory_stats(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_stats(device):
+    """Peak device memory allocated by torch and peak host RSS, in MB."""
+    stats = {}
+    if torch.device(device).type == "cuda":
+        stats["peak_device_memory_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    stats["peak_host_memory_mb"] = max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+    return stats
+
+
+def _read_proc_status(field):
+    """Value of ``field`` of /proc/self/status in MB, None off Linux."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return None
+
+
+def available_memory_mb(device):
+    """
+    Memory the training step can still allocate: free device memory on CUDA,
+    available RAM shared by the local processes on CPU.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        cached = torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        return (free + cached) / 2**20
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    if available is None:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 2**20
+    return available / int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+
+
+def measure_peak_memory_mb(fn, device):
+    """
+    Runs ``fn`` and returns its peak memory on top of the memory in use
+    before it, in MB. On CPU this is the growth of the peak RSS, which is only
+    reset between calls on Linux; elsewhere calls must grow in memory use.
+    """
+    device = torch.device(device)
+    gc.collect()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        before = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return (torch.cuda.max_memory_allocated(device) - before) / 2**20
+
+    before = _read_proc_status("VmRSS")
+    try:
+        # Resets the peak RSS (VmHWM) to the current RSS
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    if before is None:
+        before = peak_memory_stats(device)["peak_host_memory_mb"]
+    fn()
+    peak = _read_proc_status("VmHWM")
+    if peak is None:
+        peak = peak_memory_stats(device)["peak_host_memory_mb"]
+    return max(peak - before, 0.0)
@@ -0,0 +1,136 @@
+"""
+Indexed bank of CLIP text features for arbitrary words and phrases.
+
+``save_dictionary_embeddings.py --phrase_file`` streams a phrase file into a
+bank directory:
+
+- ``features.npy``: float16 [num_phrases, dim], normalized CLIP text features
+  averaged over the prompt templates, memory mapped when loaded.
+- ``phrases.bin`` / ``phrase_offsets.npy``: UTF-8 phrases and their offsets.
+- ``token_ids.bin`` / ``token_offsets.npy``: int32 ids of every phrase under
+  the Stable Diffusion tokenizer, to compose its token embedding.
+- ``meta.json``.
+
+Nothing is held in memory but the offsets, so banks of millions of phrases
+can be written and searched.
+"""
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class PhraseBankWriter:
+    def __init__(self, path, num_phrases, dim, meta=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = dict(meta or {})
+        self.features = np.lib.format.open_memmap(
+            os.path.join(path, "features.npy"), mode="w+", dtype=np.float16, shape=(num_phrases, dim)
+        )
+        self.phrase_offsets = np.zeros(num_phrases + 1, dtype=np.int64)
+        self.token_offsets = np.zeros(num_phrases + 1, dtype=np.int64)
+        self.phrase_file = open(os.path.join(path, "phrases.bin"), "wb")
+        self.token_file = open(os.path.join(path, "token_ids.bin"), "wb")
+        self.count = 0
+
+    def add(self, phrases, features, token_ids):
+        start = self.count
+        for phrase, ids in zip(phrases, token_ids):
+            data = phrase.encode("utf-8")
+            self.phrase_file.write(data)
+            self.token_file.write(np.asarray(ids, dtype=np.int32).tobytes())
+            self.phrase_offsets[self.count + 1] = self.phrase_offsets[self.count] + len(data)
+            self.token_offsets[self.count + 1] = self.token_offsets[self.count] + len(ids)
+            self.count += 1
+        self.features[start : self.count] = features.detach().cpu().numpy().astype(np.float16)
+
+    def close(self):
+        self.phrase_file.close()
+        self.token_file.close()
+        self.features.flush()
+        np.save(os.path.join(self.path, "phrase_offsets.npy"), self.phrase_offsets[: self.count + 1])
+        np.save(os.path.join(self.path, "token_offsets.npy"), self.token_offsets[: self.count + 1])
+        self.meta.update(num_phrases=self.count, dim=self.features.shape[1])
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+
+def _memmap(path, dtype):
+    # np.memmap refuses empty files
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class PhraseBank:
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        num_phrases = self.meta["num_phrases"]
+        self.features = np.load(os.path.join(path, "features.npy"), mmap_mode="r")[:num_phrases]
+        self.phrase_offsets = np.load(os.path.join(path, "phrase_offsets.npy"))
+        self.token_offsets = np.load(os.path.join(path, "token_offsets.npy"))
+        self._phrases = _memmap(os.path.join(path, "phrases.bin"), np.uint8)
+        self._token_ids = _memmap(os.path.join(path, "token_ids.bin"), np.int32)
+
+    def __len__(self):
+        return len(self.phrase_offsets) - 1
+
+    def phrase(self, i):
+        return bytes(self._phrases[self.phrase_offsets[i] : self.phrase_offsets[i + 1]]).decode("utf-8")
+
+    def phrases(self, indices):
+        return [self.phrase(int(i)) for i in indices]
+
+    def token_ids(self, indices):
+        return [
+            self._token_ids[self.token_offsets[int(i)] : self.token_offsets[int(i) + 1]].tolist()
+            for i in indices
+        ]
+
+    def top_k(self, query, k, chunk_size=65536):
+        """Indices of the ``k`` phrases most cosine-similar to ``query``, best first."""
+        query = query.detach().float().cpu().reshape(-1)
+        query = query / query.norm()
+        best_scores = torch.empty(0)
+        best_indices = torch.empty(0, dtype=torch.long)
+        for start in range(0, len(self), chunk_size):
+            chunk = torch.from_numpy(np.asarray(self.features[start : start + chunk_size], dtype=np.float32))
+            scores = torch.cat([best_scores, chunk @ query])
+            indices = torch.cat([best_indices, torch.arange(start, start + len(chunk))])
+            best_scores, top = torch.topk(scores, min(k, len(scores)))
+            best_indices = indices[top]
+        return best_indices
+
+
+def compose_embeddings(token_table, token_ids):
+    """Mean token embedding of every entry of ``token_ids`` (lists of ids)."""
+    device = token_table.device
+    lengths = torch.tensor([len(ids) for ids in token_ids], device=device)
+    flat = torch.tensor([i for ids in token_ids for i in ids], dtype=torch.long, device=device)
+    segments = torch.repeat_interleave(torch.arange(len(token_ids), device=device), lengths)
+    summed = torch.zeros(
+        len(token_ids), token_table.shape[1], dtype=token_table.dtype, device=device
+    ).index_add_(0, segments, token_table[flat])
+    return summed / lengths[:, None].to(token_table.dtype)
+
+
+def read_attribute_vocabulary(path, tokenizer):
+    """Words or phrases of an attribute vocabulary file and their token ids."""
+    with open(path) as f:
+        words = [line.strip() for line in f if line.strip()]
+    token_ids = [tokenizer.encode(w, add_special_tokens=False) for w in words]
+    return words, token_ids
+
+
+def object_vocabulary(bank, target_image_encodings, vocabulary_size, token_table):
+    """
+    The ``vocabulary_size`` bank phrases closest to the mean image encoding:
+    their bank indices, phrases and composed token embeddings.
+    """
+    if len(bank) < vocabulary_size:
+        raise ValueError(f"The phrase bank has {len(bank)} phrases, less than --vocabulary_size {vocabulary_size}")
+    indices = bank.top_k(target_image_encodings.mean(dim=0), vocabulary_size)
+    return indices, bank.phrases(indices), compose_embeddings(token_table, bank.token_ids(indices))
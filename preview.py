@@ -0,0 +1,178 @@
+"""
+Cheap preview images of the learned placeholder tokens during training.
+
+Everything that does not depend on the placeholder embeddings is prepared
+once: the prompt token ids, the unconditional text encoder states of the
+classifier-free guidance and the initial noise, so consecutive previews start
+from the same noise and only differ by what was learned. A preview then runs
+the text encoder on the prompts, ``num_inference_steps`` DPM-Solver steps at
+``resolution`` and decodes ``batch_size`` prompts at a time. Batches are
+rendered while the next one is expected to fit in ``time_budget`` seconds.
+"""
+import math
+import os
+import time
+
+import numpy as np
+import torch
+from diffusers import DPMSolverMultistepScheduler
+from PIL import Image
+
+from vae_decoding import decode_latents
+
+val_attr_templates = [
+    "a photo of {tokens} object",
+    "a photo of {tokens} shirt",
+    "a photo of {tokens} bed",
+    "a photo of {tokens} leaf",
+    "a photo of {tokens} clothes",
+    "a photo of {tokens} street",
+    "a photo of {tokens} carrot",
+    "a photo of {tokens} bottle",
+    "a photo of {tokens} house",
+    "a photo of {tokens} car",
+    "a photo of {tokens} woman"
+]
+
+val_obj_templates = [
+    "a photo of {tokens}",
+    "a photo of {tokens} at the beach",
+    "a photo of {tokens} in the jungle",
+    "a photo of {tokens} in the snow",
+    "a photo of {tokens} in the street",
+    "a photo of {tokens} on top of a pink fabric",
+    "a photo of {tokens} on top of a wooden floor",
+    "a photo of {tokens} with a city in the background",
+    "a photo of {tokens} with a mountain in the background",
+    "a photo of {tokens} with the Eiffel tower in the background",
+    "a photo of {tokens} floating on top of water"
+]
+
+
+def validation_prompts(test_prompt, obj_placeholder_token):
+    """The prompts of every comma separated token of ``test_prompt``."""
+    prompts = []
+    for val_prompt in test_prompt.split(","):
+        templates = val_obj_templates if val_prompt == obj_placeholder_token else val_attr_templates
+        prompts.append([template.format(tokens=val_prompt) for template in templates])
+    return prompts
+
+
+class PreviewRenderer:
+    def __init__(
+        self,
+        unet,
+        vae,
+        tokenizer,
+        scheduler_config,
+        prompts,
+        device,
+        dtype=torch.float32,
+        resolution=256,
+        num_inference_steps=8,
+        guidance_scale=7.5,
+        images_per_prompt=1,
+        batch_size=4,
+        time_budget=None,
+        compact_context=False,
+        seed=0,
+    ):
+        self.unet = unet
+        self.vae = vae
+        self.tokenizer = tokenizer
+        self.scheduler = DPMSolverMultistepScheduler.from_config(scheduler_config)
+        self.prompts = prompts
+        self.device = device
+        self.dtype = dtype
+        self.resolution = resolution
+        self.num_inference_steps = num_inference_steps
+        self.guidance_scale = guidance_scale
+        self.images_per_prompt = images_per_prompt
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.padding = "longest" if compact_context else "max_length"
+
+        self.batches = [
+            list(range(start, min(start + batch_size, len(prompts))))
+            for start in range(0, len(prompts), batch_size)
+        ]
+        self.input_ids = [
+            tokenizer(
+                [prompts[i] for i in batch],
+                padding=self.padding,
+                truncation=True,
+                max_length=tokenizer.model_max_length,
+                return_tensors="pt",
+            ).input_ids
+            for batch in self.batches
+        ]
+        # Filled by the first preview, the unconditional prompt does not change
+        self.uncond_states = {}
+
+        generator = torch.Generator().manual_seed(seed)
+        latent_size = resolution // 8
+        self.noise = torch.randn(
+            len(prompts) * images_per_prompt,
+            unet.config.in_channels,
+            latent_size,
+            latent_size,
+            generator=generator,
+        )
+
+    def _uncond_states(self, text_encoder, length):
+        if length not in self.uncond_states:
+            ids = self.tokenizer(
+                "", padding="max_length", max_length=length, return_tensors="pt"
+            ).input_ids.to(self.device)
+            self.uncond_states[length] = text_encoder(ids)[0].to(dtype=self.dtype)
+        return self.uncond_states[length]
+
+    def _render_batch(self, text_encoder, batch, input_ids):
+        input_ids = input_ids.to(self.device)
+        states = text_encoder(input_ids)[0].to(dtype=self.dtype)
+        uncond = self._uncond_states(text_encoder, input_ids.shape[1])
+        states = torch.cat([uncond.expand_as(states), states])
+        states = states.repeat_interleave(self.images_per_prompt, dim=0)
+        # repeat_interleave keeps the unconditional half first
+        noise_rows = [i * self.images_per_prompt + j for i in batch for j in range(self.images_per_prompt)]
+        latents = self.noise[noise_rows].to(self.device, dtype=self.dtype) * self.scheduler.init_noise_sigma
+
+        self.scheduler.set_timesteps(self.num_inference_steps, device=self.device)
+        for t in self.scheduler.timesteps:
+            latent_input = self.scheduler.scale_model_input(torch.cat([latents] * 2), t)
+            noise_pred = self.unet(latent_input, t, encoder_hidden_states=states).sample
+            noise_uncond, noise_text = noise_pred.chunk(2)
+            noise_pred = noise_uncond + self.guidance_scale * (noise_text - noise_uncond)
+            latents = self.scheduler.step(noise_pred, t, latents).prev_sample
+
+        images = decode_latents(self.vae, latents).float()
+        return (images.cpu().numpy() * 255).round().astype(np.uint8)
+
+    @torch.no_grad()
+    def render(self, text_encoder, path):
+        """
+        Renders the prompts in a grid saved to ``path``, one row per prompt,
+        and returns how many prompts fit in the time budget.
+        """
+        start = time.perf_counter()
+        rows = []
+        for batch, input_ids in zip(self.batches, self.input_ids):
+            elapsed = time.perf_counter() - start
+            # The next batch is expected to take as long as the previous ones
+            if rows and self.time_budget is not None:
+                batch_time = elapsed / math.ceil(len(rows) / self.batch_size)
+                if elapsed + batch_time > self.time_budget:
+                    break
+            images = self._render_batch(text_encoder, batch, input_ids)
+            rows += [
+                np.concatenate(list(images[i : i + self.images_per_prompt]), axis=1)
+                for i in range(0, len(images), self.images_per_prompt)
+            ]
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        Image.fromarray(np.concatenate(rows, axis=0)).save(path)
+        return {
+            "num_prompts": len(rows),
+            "num_skipped": len(self.prompts) - len(rows),
+            "time": time.perf_counter() - start,
+        }
@@ -0,0 +1,164 @@
+"""
+Wall-clock time of the phases of a training step.
+
+    timer = PhaseTimer(device)
+    with timer.phase("unet_forward"):
+        ...
+    timer.step()
+
+Phases can be entered several times per step (e.g. once per micro-batch),
+their times add up. On CUDA a phase is timed with a pair of CUDA events, so
+its kernels are charged to it without stalling the host. The events are read
+once per step in ``step()``. While a ``StepProfiler`` window is active, the
+device is synchronized around every phase instead.
+
+With ``record_ranges`` the phases, and the finer ranges of ``record``, are
+also named ranges of ``torch.profiler`` traces; ``StepProfiler`` captures such
+a trace for a window of training steps.
+"""
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class PhaseTimer:
+    def __init__(self, device, record_ranges=False, synchronize=False):
+        self.use_events = torch.device(device).type == "cuda"
+        self.record_ranges = record_ranges
+        # Synchronous timing stalls the device around every phase, only for profiling
+        self.synchronize = synchronize
+        self.current = {}
+        self.pending = []
+        self.steps = []
+        self.totals = {}
+
+    def record(self, name):
+        """Profiler range that is not timed, a no-op without ``record_ranges``."""
+        if self.record_ranges:
+            return torch.profiler.record_function(name)
+        return nullcontext()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.use_events:
+            start = time.perf_counter()
+            try:
+                with self.record(name):
+                    yield
+            finally:
+                self.add(name, time.perf_counter() - start)
+        elif self.synchronize:
+            torch.cuda.synchronize()
+            start = time.perf_counter()
+            try:
+                with self.record(name):
+                    yield
+            finally:
+                torch.cuda.synchronize()
+                self.add(name, time.perf_counter() - start)
+        else:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            try:
+                with self.record(name):
+                    yield
+            finally:
+                end.record()
+                self.pending.append((name, start, end))
+
+    def add(self, name, seconds):
+        self.current[name] = self.current.get(name, 0.0) + seconds
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def _collect(self):
+        """Adds the times of the recorded CUDA events, waiting once for the last one."""
+        if self.pending:
+            self.pending[-1][2].synchronize()
+            for name, start, end in self.pending:
+                self.add(name, start.elapsed_time(end) / 1000)
+            self.pending = []
+
+    def step(self):
+        """Closes the current training step and returns its phase times."""
+        self._collect()
+        times, self.current = self.current, {}
+        self.steps.append(times)
+        return times
+
+    def summary(self):
+        num_steps = max(len(self.steps), 1)
+        return {
+            "num_steps": len(self.steps),
+            "total": dict(self.totals),
+            "mean_per_step": {name: t / num_steps for name, t in self.totals.items()},
+        }
+
+    def save(self, path):
+        self._collect()
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "steps": self.steps}, f, indent=2)
+
+
+def step_metrics(losses, phase_times, step_time, num_samples, memory):
+    """Flat dict of the metrics of one training step, for ``accelerator.log``."""
+    metrics = {f"loss/{name}": value for name, value in losses.items()}
+    metrics.update({f"time/{name}": t for name, t in phase_times.items()})
+    metrics["time/step"] = step_time
+    metrics["samples_per_second"] = num_samples / step_time
+    metrics.update({f"memory/{name}": value for name, value in memory.items()})
+    return metrics
+
+
+def parse_profile_steps(spec):
+    """``START:END`` -> (START, END), the 0-based steps END excluded."""
+    start, end = (int(v) for v in spec.split(":"))
+    if not 0 <= start < end:
+        raise ValueError(f"Invalid --profile_steps {spec}, expected START:END with START < END")
+    return start, end
+
+
+class StepProfiler:
+    """
+    ``torch.profiler`` over the training steps ``[start, end)``. Writes
+    ``{prefix}_trace.json`` (chrome://tracing or Perfetto) and an operator
+    summary ``{prefix}_operators.txt``.
+    """
+
+    def __init__(self, spec, prefix, device):
+        self.start, self.end = parse_profile_steps(spec)
+        self.prefix = prefix
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.device(device).type == "cuda":
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = None
+        self.done = False
+
+    @property
+    def active(self):
+        return self.profiler is not None
+
+    def update(self, global_step):
+        """Call before every micro-batch with the number of finished steps."""
+        if self.profiler is None and not self.done and self.start <= global_step < self.end:
+            self.profiler = torch.profiler.profile(
+                activities=self.activities, record_shapes=True, profile_memory=True
+            )
+            self.profiler.start()
+        elif self.profiler is not None and global_step >= self.end:
+            self.finish()
+
+    def finish(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        os.makedirs(os.path.dirname(self.prefix) or ".", exist_ok=True)
+        self.profiler.export_chrome_trace(f"{self.prefix}_trace.json")
+        sort_by = "self_cuda_time_total" if len(self.activities) > 1 else "self_cpu_time_total"
+        with open(f"{self.prefix}_operators.txt", "w") as f:
+            f.write(self.profiler.key_averages().table(sort_by=sort_by, row_limit=100))
+        self.profiler = None
+        self.done = True
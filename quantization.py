@@ -0,0 +1,187 @@
+"""
+Int8 weight-only quantization of the frozen models, for CPU nodes.
+
+Every ``nn.Linear`` and ``nn.Conv2d`` of a model is replaced by a module
+holding its weight in int8, with one fp32 scale per output channel
+(symmetric, ``scale = max |w| / 127``), so a model takes about a quarter
+of its fp32 memory while computing in floating point. The weight is
+dequantized to the input dtype inside each forward, and again in backward:
+autograd only keeps the int8 weight and its scale, never the dequantized
+copy, so the training peak only grows by the weight of one layer at a time.
+
+The quantized modules have no trainable weight, but they are differentiable
+in their input: the gradients of the loss still flow through the text
+encoder and the UNet to the placeholder embeddings. Embeddings and
+normalizations are left in floating point, the token table in particular is
+still written by the training loop.
+"""
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+def quantize_per_channel(weight):
+    """int8 weight and per output channel scale of ``weight``."""
+    flat = weight.detach().float().reshape(weight.shape[0], -1)
+    scale = flat.abs().amax(dim=1).clamp(min=1e-8) / 127
+    quantized = torch.round(flat / scale[:, None]).clamp(-127, 127).to(torch.int8)
+    return quantized.reshape(weight.shape), scale
+
+
+def dequantize(weight_int8, weight_scale, dtype):
+    scale = weight_scale.to(dtype).reshape(-1, *[1] * (weight_int8.dim() - 1))
+    return weight_int8.to(dtype) * scale
+
+
+class Int8LinearFunction(torch.autograd.Function):
+    """``F.linear`` with an int8 weight, which is dequantized again in backward."""
+
+    @staticmethod
+    def forward(ctx, x, weight_int8, weight_scale, bias):
+        ctx.save_for_backward(weight_int8, weight_scale)
+        ctx.input_dtype = x.dtype
+        ctx.has_bias = bias is not None
+        return F.linear(x, dequantize(weight_int8, weight_scale, x.dtype), bias)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight_int8, weight_scale = ctx.saved_tensors
+        grad_input = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            weight = dequantize(weight_int8, weight_scale, grad_output.dtype)
+            grad_input = (grad_output @ weight).to(ctx.input_dtype)
+        if ctx.has_bias and ctx.needs_input_grad[3]:
+            grad_bias = grad_output.reshape(-1, grad_output.shape[-1]).sum(0)
+        return grad_input, None, None, grad_bias
+
+
+class Int8Conv2dFunction(torch.autograd.Function):
+    """``F.conv2d`` with an int8 weight, which is dequantized again in backward."""
+
+    @staticmethod
+    def forward(ctx, x, weight_int8, weight_scale, bias, stride, padding, dilation, groups):
+        ctx.save_for_backward(weight_int8, weight_scale)
+        ctx.input_shape = x.shape
+        ctx.input_dtype = x.dtype
+        ctx.has_bias = bias is not None
+        ctx.conv_args = (stride, padding, dilation, groups)
+        weight = dequantize(weight_int8, weight_scale, x.dtype)
+        return F.conv2d(x, weight, bias, stride, padding, dilation, groups)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight_int8, weight_scale = ctx.saved_tensors
+        grad_input = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            weight = dequantize(weight_int8, weight_scale, grad_output.dtype)
+            grad_input = torch.nn.grad.conv2d_input(
+                ctx.input_shape, weight, grad_output, *ctx.conv_args
+            ).to(ctx.input_dtype)
+        if ctx.has_bias and ctx.needs_input_grad[3]:
+            grad_bias = grad_output.sum((0, 2, 3))
+        return grad_input, None, None, grad_bias, None, None, None, None
+
+
+class Int8Linear(nn.Module):
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        quantized, scale = quantize_per_channel(linear.weight)
+        self.register_buffer("weight_int8", quantized)
+        self.register_buffer("weight_scale", scale)
+        self.bias = linear.bias
+
+    @property
+    def weight(self):
+        """The dequantized weight, for code that reads ``module.weight``."""
+        return self.dequantize(self.weight_scale.dtype)
+
+    def dequantize(self, dtype):
+        return dequantize(self.weight_int8, self.weight_scale, dtype)
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return Int8LinearFunction.apply(x, self.weight_int8, self.weight_scale, bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, int8"
+
+
+class Int8Conv2d(nn.Module):
+    def __init__(self, conv):
+        super().__init__()
+        self.in_channels = conv.in_channels
+        self.out_channels = conv.out_channels
+        self.kernel_size = conv.kernel_size
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+        quantized, scale = quantize_per_channel(conv.weight)
+        self.register_buffer("weight_int8", quantized)
+        self.register_buffer("weight_scale", scale)
+        self.bias = conv.bias
+
+    @property
+    def weight(self):
+        """The dequantized weight, for code that reads ``module.weight``."""
+        return self.dequantize(self.weight_scale.dtype)
+
+    def dequantize(self, dtype):
+        return dequantize(self.weight_int8, self.weight_scale, dtype)
+
+    def forward(self, x):
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return Int8Conv2dFunction.apply(
+            x, self.weight_int8, self.weight_scale, bias,
+            self.stride, self.padding, self.dilation, self.groups,
+        )
+
+    def extra_repr(self):
+        return (
+            f"{self.in_channels}, {self.out_channels}, kernel_size={self.kernel_size},"
+            f" stride={self.stride}, int8"
+        )
+
+
+def model_size_mb(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 2**20
+
+
+def quantize_weights(model):
+    """
+    Replaces the linear and convolution layers of the frozen ``model`` in
+    place and returns the number of replaced layers and the model size
+    before and after, in MB.
+    """
+    size_before = model_size_mb(model)
+    num_quantized = 0
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if type(child) is nn.Linear:
+                setattr(module, name, Int8Linear(child))
+            elif type(child) is nn.Conv2d and child.padding_mode == "zeros":
+                setattr(module, name, Int8Conv2d(child))
+            else:
+                continue
+            num_quantized += 1
+    return {
+        "num_quantized": num_quantized,
+        "size_before_mb": size_before,
+        "size_after_mb": model_size_mb(model),
+    }
+
+
+def quantize_frozen_models(models, logger=None):
+    """``quantize_weights`` of every named model of ``models``."""
+    stats = {}
+    for name, model in models.items():
+        stats[name] = quantize_weights(model)
+        if logger is not None:
+            logger.info(
+                f"Quantized {stats[name]['num_quantized']} layers of the {name} to int8:"
+                f" {stats[name]['size_before_mb']:.0f}MB -> {stats[name]['size_after_mb']:.0f}MB"
+            )
+    return stats
@@ -0,0 +1,37 @@
+"""
+Local-first resolution of the NLTK data and of the pretrained models.
+
+Both are looked up in the local caches first, so a machine that already has
+them starts without any network call. Only a cache miss goes to the network,
+and with ``offline`` it raises instead.
+"""
+import nltk
+
+NLTK_RESOURCES = {
+    "averaged_perceptron_tagger": "taggers/averaged_perceptron_tagger",
+    "wordnet": "corpora/wordnet",
+}
+
+
+def ensure_nltk_data(names, offline=False):
+    for name in names:
+        try:
+            nltk.data.find(NLTK_RESOURCES[name])
+        except LookupError:
+            if offline:
+                raise LookupError(
+                    f"NLTK resource {name} is not installed, run"
+                    f" `python -m nltk.downloader {name}` on a machine with network access"
+                )
+            if not nltk.download(name, quiet=True):
+                raise LookupError(f"Could not download the NLTK resource {name}")
+
+
+def load_pretrained(cls, name_or_path, offline=False, **kwargs):
+    """``cls.from_pretrained`` from the local cache, from the hub on a cache miss."""
+    try:
+        return cls.from_pretrained(name_or_path, local_files_only=True, **kwargs)
+    except OSError:
+        if offline:
+            raise
+    return cls.from_pretrained(name_or_path, **kwargs)
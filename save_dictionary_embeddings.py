@@ -1,13 +1,22 @@
 """
 From:
     Conceptor: https://github.com/hila-chefer/Conceptor
+
+Without --phrase_file, embeds every token of the Stable Diffusion tokenizer
+into --path_to_encoder_embeddings. With --phrase_file, streams the phrases of
+the file (one per line) into the indexed phrase bank --phrase_bank, see
+phrase_bank.py.
 """
 import argparse
+import itertools
 
 from diffusers import StableDiffusionPipeline
 from diffusers.schedulers import LMSDiscreteScheduler
 import torch
-from transformers import CLIPModel, CLIPProcessor
+from tqdm.auto import tqdm
+from transformers import CLIPModel, CLIPProcessor, CLIPTokenizer
+
+from phrase_bank import PhraseBankWriter
 
 
 def parse_args():
@@ -38,14 +47,124 @@ def parse_args():
         default="./clip_text_encoding.pt",
         help="Path to the saved embeddings matrix of the text encoder",
     )
+    parser.add_argument(
+        "--phrase_file",
+        type=str,
+        default=None,
+        help="Text file with one word or phrase per line to embed into a phrase bank.",
+    )
+    parser.add_argument(
+        "--phrase_bank",
+        type=str,
+        default="./phrase_bank",
+        help="Output directory of the phrase bank.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="Number of phrases embedded at once, with all the templates.",
+    )
 
     args = parser.parse_args()
 
     return args
 
 
+IMAGENET_TEMPLATES = [
+    "a photo of a {}",
+    "a rendering of a {}",
+    "a cropped photo of the {}",
+    "the photo of a {}",
+    "a photo of a clean {}",
+    "a photo of a dirty {}",
+    "a dark photo of the {}",
+    "a photo of my {}",
+    "a photo of the cool {}",
+    "a close-up photo of a {}",
+    "a bright photo of the {}",
+    "a cropped photo of a {}",
+    "a photo of the {}",
+    "a good photo of the {}",
+    "a photo of one {}",
+    "a close-up photo of the {}",
+    "a rendition of the {}",
+    "a photo of the clean {}",
+    "a rendition of a {}",
+    "a photo of a nice {}",
+    "a good photo of a {}",
+    "a photo of the nice {}",
+    "a photo of the small {}",
+    "a photo of the weird {}",
+    "a photo of the large {}",
+    "a photo of a cool {}",
+    "a photo of a small {}",
+]
+
+
+def encode_phrases(model, processor, phrases, templates, device):
+    """Normalized CLIP text features of each phrase, averaged over the templates."""
+    texts = [template.format(phrase) for phrase in phrases for template in templates]
+    with torch.no_grad():
+        text_preprocessed = processor(text=texts, return_tensors="pt", padding=True, truncation=True)
+        text_encodings = model.get_text_features(
+            input_ids=text_preprocessed["input_ids"].to(device),
+            attention_mask=text_preprocessed["attention_mask"].to(device),
+        )
+    text_encodings /= text_encodings.norm(dim=-1, keepdim=True)
+    text_encodings = text_encodings.reshape(len(phrases), len(templates), -1).mean(dim=1)
+    text_encodings /= text_encodings.norm(dim=-1, keepdim=True)
+    return text_encodings.float()
+
+
+def stream_phrases(path):
+    with open(path) as f:
+        for line in f:
+            phrase = line.strip()
+            if phrase:
+                yield phrase
+
+
+def save_phrase_bank(args, model, processor, device):
+    tokenizer = CLIPTokenizer.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="tokenizer"
+    )
+    # A first pass only counts, so the features can be written to a memory map
+    num_phrases = sum(1 for _ in stream_phrases(args.phrase_file))
+    writer = PhraseBankWriter(
+        args.phrase_bank,
+        num_phrases,
+        model.config.projection_dim,
+        meta={
+            "phrase_file": args.phrase_file,
+            "clip_model": args.clip_model,
+            "tokenizer": args.pretrained_model_name_or_path,
+            "templates": IMAGENET_TEMPLATES,
+        },
+    )
+    phrases = stream_phrases(args.phrase_file)
+    progress_bar = tqdm(total=num_phrases, desc="Phrases")
+    while True:
+        batch = list(itertools.islice(phrases, args.batch_size))
+        if not batch:
+            break
+        features = encode_phrases(model, processor, batch, IMAGENET_TEMPLATES, device)
+        token_ids = [tokenizer.encode(p, add_special_tokens=False) for p in batch]
+        writer.add(batch, features, token_ids)
+        progress_bar.update(len(batch))
+    progress_bar.close()
+    writer.close()
+
+
 def main():
     args = parse_args()
+    if args.phrase_file is not None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model = CLIPModel.from_pretrained(args.clip_model).to(device).eval()
+        processor = CLIPProcessor.from_pretrained(args.clip_model)
+        save_phrase_bank(args, model, processor, device)
+        return
+
     model = CLIPModel.from_pretrained(args.clip_model).cuda()
     processor = CLIPProcessor.from_pretrained(args.clip_model)
 
@@ -60,36 +179,6 @@ def main():
         pipe.text_encoder.text_model.embeddings.token_embedding.weight.clone().detach()
     )
 
-    imagenet_templates = [
-        "a photo of a {}",
-        "a rendering of a {}",
-        "a cropped photo of the {}",
-        "the photo of a {}",
-        "a photo of a clean {}",
-        "a photo of a dirty {}",
-        "a dark photo of the {}",
-        "a photo of my {}",
-        "a photo of the cool {}",
-        "a close-up photo of a {}",
-        "a bright photo of the {}",
-        "a cropped photo of a {}",
-        "a photo of the {}",
-        "a good photo of the {}",
-        "a photo of one {}",
-        "a close-up photo of the {}",
-        "a rendition of the {}",
-        "a photo of the clean {}",
-        "a rendition of a {}",
-        "a photo of a nice {}",
-        "a good photo of a {}",
-        "a photo of the nice {}",
-        "a photo of the small {}",
-        "a photo of the weird {}",
-        "a photo of the large {}",
-        "a photo of a cool {}",
-        "a photo of a small {}",
-    ]
-
     def get_embedding_for_prompt(prompt, templates):
         with torch.no_grad():
             texts = [
@@ -109,7 +198,7 @@ def main():
 
     top_encodings_open_clip = [
             get_embedding_for_prompt(
-                    pipe.tokenizer.decoder[token], imagenet_templates
+                    pipe.tokenizer.decoder[token], IMAGENET_TEMPLATES
             )
             for token in range(orig_embeddings.shape[0])
     ]
@@ -0,0 +1,87 @@
+"""
+Timestep samplers for the diffusion loss.
+
+``UniformTimestepSampler`` reproduces the default behaviour of drawing
+timesteps uniformly. ``LossAwareTimestepSampler`` splits the timesteps into
+buckets, keeps an online estimate of the second moment of the loss in every
+bucket and samples buckets proportionally to its square root. The returned
+weights make the weighted loss an unbiased estimate of the uniform one.
+"""
+import numpy as np
+import torch
+
+
+class UniformTimestepSampler:
+    def __init__(self, num_timesteps):
+        self.num_timesteps = num_timesteps
+
+    def sample(self, batch_size, device):
+        timesteps = torch.randint(
+            0, self.num_timesteps, (batch_size,), device=device
+        ).long()
+        weights = torch.ones(batch_size, device=device)
+        return timesteps, weights
+
+    def update(self, timesteps, losses):
+        pass
+
+
+class LossAwareTimestepSampler:
+    def __init__(
+        self,
+        num_timesteps,
+        num_buckets=20,
+        ema=0.9,
+        min_count=2,
+        uniform_prob=0.1,
+    ):
+        self.num_timesteps = num_timesteps
+        self.num_buckets = min(num_buckets, num_timesteps)
+        self.ema = ema
+        self.min_count = min_count
+        self.uniform_prob = uniform_prob
+
+        self.boundaries = np.linspace(0, num_timesteps, self.num_buckets + 1).astype(np.int64)
+        self.bucket_sizes = np.diff(self.boundaries)
+        self.loss_sq = np.zeros(self.num_buckets)
+        self.counts = np.zeros(self.num_buckets, dtype=np.int64)
+
+    def bucket_probs(self):
+        uniform = self.bucket_sizes / self.num_timesteps
+        if (self.counts < self.min_count).any():
+            return uniform
+        probs = np.sqrt(self.loss_sq)
+        probs = probs / probs.sum()
+        return (1 - self.uniform_prob) * probs + self.uniform_prob * uniform
+
+    def sample(self, batch_size, device):
+        probs = self.bucket_probs()
+        buckets = np.random.choice(self.num_buckets, size=batch_size, p=probs)
+        offsets = np.random.randint(0, self.bucket_sizes[buckets])
+        timesteps = self.boundaries[buckets] + offsets
+
+        # p_uniform(t) / p(t) with p(t) = probs[b] / size[b]
+        weights = self.bucket_sizes[buckets] / (self.num_timesteps * probs[buckets])
+        return (
+            torch.from_numpy(timesteps).long().to(device),
+            torch.from_numpy(weights).float().to(device),
+        )
+
+    def update(self, timesteps, losses):
+        timesteps = timesteps.detach().cpu().numpy()
+        losses = losses.detach().float().cpu().numpy()
+        buckets = np.searchsorted(self.boundaries, timesteps, side="right") - 1
+        for b, loss in zip(buckets, losses):
+            if self.counts[b] == 0:
+                self.loss_sq[b] = loss ** 2
+            else:
+                self.loss_sq[b] = self.ema * self.loss_sq[b] + (1 - self.ema) * loss ** 2
+            self.counts[b] += 1
+
+
+def get_timestep_sampler(name, num_timesteps, num_buckets=20):
+    if name == "uniform":
+        return UniformTimestepSampler(num_timesteps)
+    elif name == "loss_aware":
+        return LossAwareTimestepSampler(num_timesteps, num_buckets=num_buckets)
+    raise ValueError(f"Unknown timestep sampler {name}")
@@ -5,10 +5,10 @@ import math
 import os
 from pathlib import Path
 import random
+import time
 import PIL
 from PIL import Image, ImageOps
 import numpy
-import matplotlib.pyplot as plt
 from itertools import chain
 from accelerate import Accelerator
 from accelerate.logging import get_logger
@@ -17,21 +17,15 @@ import diffusers
 from diffusers import (
     AutoencoderKL,
     DDPMScheduler,
-    DPMSolverMultistepScheduler,
-    DiffusionPipeline,
     UNet2DConditionModel,
 )
-from diffusers import StableDiffusionPipeline
 from diffusers.optimization import get_scheduler
-from diffusers.schedulers import LMSDiscreteScheduler
 
 import numpy as np
 from packaging import version
 import PIL
 from PIL import Image
 from tqdm.auto import tqdm
-import nltk
-from nltk.corpus import wordnet
 
 import torch
 from torch import nn
@@ -42,6 +36,29 @@ from torchvision import transforms
 import transformers
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPModel, CLIPProcessor
 
+from timestep_sampler import get_timestep_sampler
+from attention import ATTENTION_BACKENDS, set_attention_backend
+from memory_utils import peak_memory_stats, reset_peak_memory_stats
+from batch_planner import plan_batch_size, probe_training_step
+from profiling import PhaseTimer, StepProfiler, step_metrics
+from distributed_utils import gather_mean, gather_min, parameters_in_sync
+from curriculum import (
+    parse_resolution_schedule,
+    resolution_at,
+    schedule_sizes,
+    step_time_per_resolution,
+)
+from early_stopping import RankingStabilityStopper
+from resources import ensure_nltk_data, load_pretrained
+from phrase_bank import PhraseBank, object_vocabulary
+from attribute_vocabulary import load_attribute_vocabulary, resolve_word_size
+from vocabulary_scoring import FullVocabulary, noun_mask
+from quantization import quantize_frozen_models
+from archive_source import ShardIndex, open_image
+from image_selection import encode_images, list_images, select_concept_images
+from preview import PreviewRenderer, validation_prompts
+from concept_library import add_concept, file_hash, find_nearest_concept
+
 if version.parse(version.parse(PIL.__version__).base_version) >= version.parse("9.1.0"):
     PIL_INTERPOLATION = {
         "linear": PIL.Image.Resampling.BILINEAR,
@@ -61,7 +78,7 @@ else:
 
 logger = get_logger(__name__)
 
-def parse_args():
+def parse_args(input_args=None):
 
     parser = argparse.ArgumentParser(description="Simple example of a training script.")
     parser.add_argument('--pretrained_model_name_or_path', type=str, default="stabilityai/stable-diffusion-2-1-base", help='The name or path of the pretrained model.')
@@ -77,11 +94,52 @@ def parse_args():
     parser.add_argument('--learning_rate_obj', type=float, default=1e-3, help='Learning rate for the object network.')
     parser.add_argument('--max_train_steps', type=int, default=30, help='Maximum number of training steps.')
     parser.add_argument('--seed', type=int, default=1000, help='Seed for randomness.')
-    parser.add_argument('--word_size', type=int, default=22, help='Number of attribute words from LLM')
+    parser.add_argument('--word_size', type=int, default=None, help='Number of attribute words from LLM, all the words of --vocabulary_path by default')
+    parser.add_argument('--offline', action='store_true', help='Never access the network: the models and the NLTK data must be in the local caches.')
+    parser.add_argument('--clip_model', type=str, default="openai/clip-vit-base-patch32", help='CLIP model used to encode the concept images.')
     parser.add_argument('--path_to_encoder_embeddings', type=str, default='./clip_text_encoding.pt', help='Path to the encoder embeddings.')
+    parser.add_argument('--train_archive', type=str, default=None, help='Glob pattern of tar shards holding the concept folders, read without extracting. --train_data_dir is then the concept folder inside the shards, e.g. time/clock.')
+    parser.add_argument('--archive_index_cache', type=str, default='./archive_index', help='Directory of the cached listings of the --train_archive shards.')
+    parser.add_argument('--dedup_threshold', type=float, default=None, help='Drop concept images whose CLIP image feature has at least this cosine similarity with an image already kept, e.g. 0.95.')
+    parser.add_argument('--max_concept_images', type=int, default=None, help='Keep at most this many concept images, a representative subset of the ones left after --dedup_threshold.')
+    parser.add_argument('--test_prompt', type=str, default="<>,[]", help='Prompt for validation.')
+    parser.add_argument('--preview', action='store_true', help='Render cheap preview images of the placeholder tokens at every validation step, see preview.py.')
+    parser.add_argument('--preview_resolution', type=int, default=256, help='Resolution of the preview images.')
+    parser.add_argument('--preview_steps', type=int, default=8, help='DPM-Solver steps of the preview images.')
+    parser.add_argument('--preview_guidance_scale', type=float, default=7.5, help='Classifier-free guidance scale of the preview images.')
+    parser.add_argument('--preview_images_per_prompt', type=int, default=1, help='Preview images per validation prompt.')
+    parser.add_argument('--preview_batch_size', type=int, default=4, help='Validation prompts denoised and decoded together.')
+    parser.add_argument('--preview_time_budget', type=float, default=None, help='Seconds a preview may take, the prompts that do not fit are skipped.')
+    parser.add_argument('--vocabulary_cache', type=str, default='./vocabulary_cache', help='Directory of the compiled attribute vocabularies, see attribute_vocabulary.py.')
+    parser.add_argument('--full_vocabulary', action='store_true', help='Pick the --vocabulary_size object words among all the noun tokens of the tokenizer at every step, see vocabulary_scoring.py.')
+    parser.add_argument('--vocabulary_scoring_precision', type=str, default=None, choices=["fp32", "fp16", "bf16"], help='Precision of the full vocabulary scoring, fp16 on GPU and bf16 on CPU by default.')
+    parser.add_argument('--vocabulary_chunk_size', type=int, default=8192, help='Tokens scored at once by --full_vocabulary.')
+    parser.add_argument('--phrase_bank', type=str, default=None, help='Phrase bank directory written by save_dictionary_embeddings.py --phrase_file. Its phrases are the object vocabulary.')
     parser.add_argument('--vocabulary_path', type=str, default='image/time/attr.txt', required = False, help='Path to the attribute words from LLM.')  
     parser.add_argument("--num_train_epochs", type=int, default=1000, help='How many epochs will be trained.')
     parser.add_argument("--num_attr_take", type=int, default=10, help='How many attribute words are taken into consideration in calculation.')
+    parser.add_argument('--timestep_sampling', type=str, default='uniform', choices=['uniform', 'loss_aware'], help='How diffusion timesteps are sampled during training.')
+    parser.add_argument('--timestep_buckets', type=int, default=20, help='Number of timestep buckets tracked by the loss-aware sampler.')
+    parser.add_argument('--noise_draws_per_latent', type=int, default=1, help='Number of noise/timestep draws per latent in each UNet batch. The UNet batch (and its memory) grows to train_batch_size * noise_draws_per_latent.')
+    parser.add_argument('--int8_weights', action='store_true', help='Quantize the weights of the frozen UNet, text encoder and VAE to int8 on load, see quantization.py. Meant for CPU nodes.')
+    parser.add_argument('--gradient_checkpointing', action='store_true', help='Recompute the activations of the frozen UNet and text encoder in the backward pass to save memory.')
+    parser.add_argument('--attention_backend', type=str, default='default', choices=ATTENTION_BACKENDS, help='Attention implementation of the UNet, for training and validation.')
+    parser.add_argument('--attention_slice_size', type=int, default=None, help='Slice size of the sliced attention backend. Defaults to half of the heads.')
+    parser.add_argument('--attention_chunk_size', type=int, default=1024, help='Number of query positions per chunk of the chunked attention backend.')
+    parser.add_argument('--auto_batch_size', action='store_true', help='Probe the training step at startup and use the largest train_batch_size that fits in memory, raising gradient_accumulation_steps to keep the number of samples per update.')
+    parser.add_argument('--memory_budget_mb', type=float, default=None, help='Memory budget of --auto_batch_size. Defaults to the free device memory, or to the available RAM on CPU.')
+    parser.add_argument('--compact_context', action='store_true', help='Condition on the unpadded prompt tokens instead of padding them to 77 positions.')
+    parser.add_argument('--resolution_schedule', type=str, default=None, help='Progressive resolution curriculum, e.g. "256:20,512" trains the first 20 steps at 256 and the rest at --resolution.')
+    parser.add_argument('--profile_steps', type=str, default=None, help='Profile the training steps START:END (0-based, END excluded) with torch.profiler and write a Chrome trace and an operator summary to --output_dir.')
+    parser.add_argument('--early_stopping', action='store_true', help='Stop before --max_train_steps once the vocabulary rankings and the loss have settled.')
+    parser.add_argument('--early_stopping_top_k', type=int, default=10, help='Size of the top of the rankings whose stability is tracked.')
+    parser.add_argument('--early_stopping_min_overlap', type=float, default=0.9, help='Minimum top-k overlap between consecutive steps counted as stable.')
+    parser.add_argument('--early_stopping_loss_tolerance', type=float, default=0.01, help='Maximum relative change of the smoothed loss counted as stable.')
+    parser.add_argument('--early_stopping_patience', type=int, default=5, help='Number of consecutive stable steps before stopping.')
+    parser.add_argument('--early_stopping_min_steps', type=int, default=10, help='Never stop before this many steps.')
+    parser.add_argument('--concept_library', type=str, default=None, help='Directory of previously decomposed concepts. Trained concepts are added to it.')
+    parser.add_argument('--warm_start', action='store_true', help='Initialize the networks from the most similar concept in --concept_library.')
+    parser.add_argument('--warm_start_min_similarity', type=float, default=0.8, help='Minimum CLIP image similarity for a library concept to be used for warm start.')
     parser.add_argument(
         "--revision",
         type=str,
@@ -223,7 +281,10 @@ def parse_args():
         help="For distributed training: local_rank",
     )
 
-    args = parser.parse_args()
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
 
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
     if env_local_rank != -1 and env_local_rank != args.local_rank:
@@ -246,15 +307,6 @@ def set_seed(seed=1000):
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
 
-set_seed()
-
-def decode_latents(vae, latents):
-    latents = 1 / 0.18215 * latents
-    image = vae.decode(latents).sample
-    image = (image / 2 + 0.5).clamp(0, 1)
-    image = image.permute(0, 2, 3, 1)
-    return image
-
 class CUSDataset(Dataset):
 
     def __init__(
@@ -269,19 +321,29 @@ class CUSDataset(Dataset):
         attr_placeholder_token="*",
         obj_placeholder_token="*",
         center_crop=False,
+        compact_context=False,
+        extra_sizes=(),
+        image_paths=None,
     ):
         self.data_root = data_root
         self.tokenizer = tokenizer
         self.size = size
+        # Other resolutions returned as pixel_values_{size}, e.g. for a resolution curriculum
+        self.extra_sizes = tuple(s for s in extra_sizes if s != size)
         self.attr_placeholder_token = attr_placeholder_token
         self.obj_placeholder_token = obj_placeholder_token
         self.center_crop = center_crop
+        # Without padding, the text encoder and the cross-attention only see the
+        # prompt tokens. Thanks to the causal mask their states are unchanged.
+        self.padding = "do_not_pad" if compact_context else "max_length"
         self.flip_p = flip_p
 
-        self.image_paths = [
-            os.path.join(self.data_root, file_path)
-            for file_path in os.listdir(self.data_root)
-        ]
+        if image_paths is None:
+            image_paths = [
+                os.path.join(self.data_root, file_path)
+                for file_path in os.listdir(self.data_root)
+            ]
+        self.image_paths = image_paths
 
         self.num_images = len(self.image_paths)
         self._length = self.num_images
@@ -304,7 +366,7 @@ class CUSDataset(Dataset):
 
     def __getitem__(self, i):
         example = {}
-        image = Image.open(self.image_paths[i % self.num_images])
+        image = open_image(self.image_paths[i % self.num_images])
 
         if image.mode != "RGB":
             image = image.convert("RGB")
@@ -315,7 +377,7 @@ class CUSDataset(Dataset):
 
         example["input_ids"] = self.tokenizer(
             self.templates,
-            padding="max_length",
+            padding=self.padding,
             truncation=True,
             max_length=self.tokenizer.model_max_length,
             return_tensors="pt",
@@ -323,7 +385,7 @@ class CUSDataset(Dataset):
     
         example["input_ids_obj"] = self.tokenizer(
             text_obj,
-            padding="max_length",
+            padding=self.padding,
             truncation=True,
             max_length=self.tokenizer.model_max_length,
             return_tensors="pt",
@@ -345,35 +407,30 @@ class CUSDataset(Dataset):
             ]
 
         image = Image.fromarray(img)
-        image = image.resize((self.size, self.size), resample=self.interpolation)
-
+        # Flip before resizing so the image is flipped the same way at every size
         image = self.flip_transform(image)
-        image = np.array(image).astype(np.uint8)
-        image = (image / 127.5 - 1.0).astype(np.float32)
 
-        example["pixel_values"] = torch.from_numpy(image).permute(2, 0, 1)
+        for size in (self.size,) + self.extra_sizes:
+            resized = image.resize((size, size), resample=self.interpolation)
+            resized = np.array(resized).astype(np.uint8)
+            resized = (resized / 127.5 - 1.0).astype(np.float32)
+
+            key = "pixel_values" if size == self.size else f"pixel_values_{size}"
+            example[key] = torch.from_numpy(resized).permute(2, 0, 1)
         return example
 
-def get_clip_encodings(data_root):
-    clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to("cuda")
-    clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+def get_clip_encodings(
+    data_root, device, clip_model_name="openai/clip-vit-base-patch32", offline=False, image_paths=None
+):
+    clip_model = load_pretrained(CLIPModel, clip_model_name, offline=offline).to(device)
+    clip_processor = load_pretrained(CLIPProcessor, clip_model_name, offline=offline)
 
-    image_paths = [
+    if image_paths is None:
+        image_paths = [
             f"{data_root}/{i}.jpg"
             for i in range(len(glob.glob(f"{data_root}/*.jpg")))
-    ]
-    images = []
-    for image_p in image_paths:
-        image = Image.open(image_p)
-
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        images.append(image)
-
-    images_processed = clip_processor(images=images, return_tensors="pt")["pixel_values"].cuda()
-    
-    target_image_encodings = clip_model.get_image_features(images_processed)
-    target_image_encodings /= target_image_encodings.norm(dim=-1, keepdim=True)
+        ]
+    target_image_encodings = encode_images(clip_model, clip_processor, image_paths, device)
     del clip_model
     torch.cuda.empty_cache()
 
@@ -382,8 +439,9 @@ def get_clip_encodings(data_root):
 def get_vocabulary_indices(
     args, target_image_encodings, tokenizer, vocabulary_size
 ):
-    clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to("cuda")
-    normalized_text_encodings = torch.load(args.path_to_encoder_embeddings)
+    normalized_text_encodings = torch.load(
+        args.path_to_encoder_embeddings, map_location=target_image_encodings.device
+    )
 
     # Calculate cosine similarities for the average image
     mean_target_image = target_image_encodings.mean(dim=0).reshape(1, -1)
@@ -419,12 +477,12 @@ class WeightLearningNetwork(nn.Module):
 
         return weights
 
-nltk.download('averaged_perceptron_tagger')
-nltk.download('wordnet')
-
 def main():
+    main_start = time.perf_counter()
     args = parse_args()
-    set_seed()
+    set_seed(args.seed)
+    ensure_nltk_data(["averaged_perceptron_tagger"], offline=args.offline)
+    resolution_schedule = parse_resolution_schedule(args.resolution_schedule, args.resolution)
     
     logging_dir = os.path.join(args.output_dir, args.logging_dir)
 
@@ -447,26 +505,38 @@ def main():
         os.makedirs(args.output_dir, exist_ok=True)
 
     # Load tokenizer
-    tokenizer = CLIPTokenizer.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="tokenizer"
+    tokenizer = load_pretrained(
+        CLIPTokenizer,
+        args.pretrained_model_name_or_path,
+        offline=args.offline,
+        subfolder="tokenizer",
     )
 
     # Load scheduler and models
-    noise_scheduler = DDPMScheduler.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="scheduler"
+    noise_scheduler = load_pretrained(
+        DDPMScheduler,
+        args.pretrained_model_name_or_path,
+        offline=args.offline,
+        subfolder="scheduler",
     )
-    text_encoder = CLIPTextModel.from_pretrained(
+    text_encoder = load_pretrained(
+        CLIPTextModel,
         args.pretrained_model_name_or_path,
+        offline=args.offline,
         subfolder="text_encoder",
         revision=args.revision,
     )
-    vae = AutoencoderKL.from_pretrained(
+    vae = load_pretrained(
+        AutoencoderKL,
         args.pretrained_model_name_or_path,
+        offline=args.offline,
         subfolder="vae",
         revision=args.revision,
     )
-    unet = UNet2DConditionModel.from_pretrained(
+    unet = load_pretrained(
+        UNet2DConditionModel,
         args.pretrained_model_name_or_path,
+        offline=args.offline,
         subfolder="unet",
         revision=args.revision,
     )
@@ -487,20 +557,54 @@ def main():
     text_encoder.text_model.final_layer_norm.requires_grad_(False)
     text_encoder.text_model.embeddings.position_embedding.requires_grad_(False)
 
+    # The layers are int8, the token table is still written by the loop
+    quantization = None
+    if args.int8_weights:
+        quantization = quantize_frozen_models(
+            {"unet": unet, "text_encoder": text_encoder, "vae": vae}, logger
+        )
+
+    set_attention_backend(
+        unet,
+        args.attention_backend,
+        slice_size=args.attention_slice_size,
+        chunk_size=args.attention_chunk_size,
+    )
+
+    if args.gradient_checkpointing:
+        # Both models only checkpoint in training mode, they have no dropout
+        unet.enable_gradient_checkpointing()
+        text_encoder.gradient_checkpointing_enable()
+        unet.train()
+        text_encoder.train()
+
     if args.allow_tf32:
         torch.backends.cuda.matmul.allow_tf32 = True
 
     if args.scale_lr:
-        args.learning_rate = (
-            args.learning_rate
-            * args.gradient_accumulation_steps
+        lr_scale = (
+            args.gradient_accumulation_steps
             * args.train_batch_size
             * accelerator.num_processes
-        ) 
+        )
+        args.learning_rate_attr = args.learning_rate_attr * lr_scale
+        args.learning_rate_obj = args.learning_rate_obj * lr_scale
+
+    # Compiled attribute vocabulary, cached across runs
+    with accelerator.main_process_first():
+        attr_vocabulary = load_attribute_vocabulary(
+            args.vocabulary_path,
+            tokenizer,
+            text_encoder.get_input_embeddings().weight,
+            args.vocabulary_cache,
+            args.pretrained_model_name_or_path,
+        )
+    args.word_size = resolve_word_size(attr_vocabulary, args.word_size)
 
     # Initialize the MLP
-    net_attr = WeightLearningNetwork(1024, args.word_size)
-    net_obj = WeightLearningNetwork(1024, args.vocabulary_size)
+    embedding_dim = text_encoder.config.hidden_size
+    net_attr = WeightLearningNetwork(embedding_dim, args.word_size)
+    net_obj = WeightLearningNetwork(embedding_dim, args.vocabulary_size)
 
     # Initialize the optimizer
     optimizer = torch.optim.AdamW(
@@ -511,6 +615,49 @@ def main():
         eps=args.adam_epsilon
     )
 
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+
+    # The frozen text encoder runs in weight_dtype like the UNet. The fp32 token
+    # table is kept for the vocabularies: the nets, the placeholder vectors and
+    # the embeddings they are composed from are the only fp32 master copies.
+    orig_embeds_params = text_encoder.get_input_embeddings().weight.data.clone()
+    text_encoder.to(dtype=weight_dtype)
+
+    # Concept images, without near-duplicates with --dedup_threshold
+    image_paths = None
+    concept_metadata = None
+    if args.train_archive is not None:
+        image_paths, concept_metadata = ShardIndex.from_pattern(
+            args.train_archive, args.archive_index_cache
+        ).read_concept(args.train_data_dir)
+        logger.info(f"Read {len(image_paths)} images of {args.train_data_dir} from {args.train_archive}")
+    elif args.dedup_threshold is not None or args.max_concept_images is not None:
+        image_paths = list_images(args.train_data_dir)
+    target_image_encodings = get_clip_encodings(
+        args.train_data_dir, accelerator.device, args.clip_model, offline=args.offline, image_paths=image_paths
+    )
+    image_selection = None
+    if args.dedup_threshold is not None or args.max_concept_images is not None:
+        keep, image_selection = select_concept_images(
+            image_paths,
+            target_image_encodings,
+            threshold=args.dedup_threshold,
+            max_images=args.max_concept_images,
+            repeats=args.repeats,
+        )
+        image_paths = [image_paths[i] for i in keep]
+        target_image_encodings = target_image_encodings[keep]
+        logger.info(
+            f"Training on {image_selection['num_kept']} of {image_selection['num_images']} images"
+            f" ({image_selection['num_near_duplicates']} near-duplicates,"
+            f" {image_selection['num_capped']} over --max_concept_images),"
+            f" {image_selection['compute_saved']:.0%} fewer samples per epoch"
+        )
+
     # Create dataset and DataLoaders:
     train_dataset = CUSDataset(
         data_root=args.train_data_dir,
@@ -520,8 +667,47 @@ def main():
         obj_placeholder_token=args.obj_placeholder_token,
         repeats=args.repeats,
         center_crop=args.center_crop,
+        compact_context=args.compact_context,
+        extra_sizes=schedule_sizes(resolution_schedule),
+        image_paths=image_paths,
         split="train",
     )
+
+    # Largest micro-batch that fits, with the same number of samples per update
+    batch_plan = None
+    if args.auto_batch_size:
+        unet.to(accelerator.device, dtype=weight_dtype)
+        vae.to(accelerator.device, dtype=weight_dtype)
+        text_encoder.to(accelerator.device)
+        example = train_dataset[0]
+        batch_plan = plan_batch_size(
+            lambda batch_size: probe_training_step(
+                unet,
+                vae,
+                text_encoder,
+                noise_scheduler,
+                [example["input_ids"], example["input_ids_obj"]],
+                batch_size,
+                max(schedule_sizes(resolution_schedule)),
+                noise_draws=args.noise_draws_per_latent,
+                dtype=weight_dtype,
+            ),
+            args.train_batch_size * args.gradient_accumulation_steps,
+            accelerator.device,
+            memory_budget_mb=args.memory_budget_mb,
+        )
+        # Every process must use the same batch size
+        args.train_batch_size = gather_min(accelerator, batch_plan["micro_batch_size"])
+        args.gradient_accumulation_steps = batch_plan["effective_batch_size"] // args.train_batch_size
+        batch_plan["micro_batch_size"] = args.train_batch_size
+        batch_plan["gradient_accumulation_steps"] = args.gradient_accumulation_steps
+        accelerator.gradient_accumulation_steps = args.gradient_accumulation_steps
+        logger.info(
+            f"Batch plan: train_batch_size {args.train_batch_size}, gradient_accumulation_steps"
+            f" {args.gradient_accumulation_steps} (estimated peak {batch_plan['estimated_peak_memory_mb']:.0f}MB"
+            f" of {batch_plan['memory_budget_mb']:.0f}MB)"
+        )
+
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=args.train_batch_size,
@@ -546,17 +732,18 @@ def main():
         * args.gradient_accumulation_steps,
     )
 
-    text_encoder, optimizer, train_dataloader, lr_scheduler, net_attr, net_obj = (
+    # The text encoder has no trainable parameters, so it is not wrapped for
+    # data parallel training. Only the networks are.
+    optimizer, train_dataloader, lr_scheduler, net_attr, net_obj = (
         accelerator.prepare(
-        text_encoder, optimizer, train_dataloader, lr_scheduler, net_attr, net_obj
+        optimizer, train_dataloader, lr_scheduler, net_attr, net_obj
         )
     )
+    text_encoder.to(accelerator.device)
 
-    weight_dtype = torch.float32
-    if accelerator.mixed_precision == "fp16":
-        weight_dtype = torch.float16
-    elif accelerator.mixed_precision == "bf16":
-        weight_dtype = torch.bfloat16
+    # Same initialization on every process, different noise afterwards
+    if accelerator.num_processes > 1:
+        set_seed(args.seed + accelerator.process_index)
 
     unet.to(accelerator.device, dtype=weight_dtype)
     vae.to(accelerator.device, dtype=weight_dtype)
@@ -592,11 +779,7 @@ def main():
     progress_bar.set_description("Steps")
 
     # Keep original embeddings as reference
-    orig_embeds_params = (
-        accelerator.unwrap_model(text_encoder)
-        .get_input_embeddings()
-        .weight.data.clone()
-    )
+    orig_embeds_params = orig_embeds_params.to(accelerator.device)
 
     norms = [i.norm().item() for i in orig_embeds_params]
     avg_norm = np.mean(norms)
@@ -604,103 +787,183 @@ def main():
 
     # Get object vocabulary
     num_tokens = args.vocabulary_size
-    target_image_encodings = get_clip_encodings(args.train_data_dir)
-    vocabulary_indices = get_vocabulary_indices(
-        args, target_image_encodings, tokenizer, num_tokens
-    )
+    phrase_bank = PhraseBank(args.phrase_bank) if args.phrase_bank is not None else None
+    full_vocabulary = None
+    if args.full_vocabulary:
+        with accelerator.main_process_first():
+            full_vocabulary = FullVocabulary(
+                tokenizer, orig_embeds_params, num_tokens, args.vocabulary_cache,
+                args.vocabulary_scoring_precision, args.vocabulary_chunk_size,
+            )
+        vocabulary_indices, vocabulary_words, vocabulary = full_vocabulary.select(
+            accelerator.unwrap_model(net_obj)
+        )
+    elif phrase_bank is not None:
+        vocabulary_indices, vocabulary_words, vocabulary = object_vocabulary(
+            phrase_bank, target_image_encodings, num_tokens, orig_embeds_params
+        )
+    else:
+        vocabulary_indices = get_vocabulary_indices(
+            args, target_image_encodings, tokenizer, num_tokens
+        )
+        vocabulary_words = [tokenizer.decode(i) for i in vocabulary_indices]
+        vocabulary = orig_embeds_params[vocabulary_indices]
     target_image_encodings.detach_().requires_grad_(False)
-    vocabulary = orig_embeds_params[vocabulary_indices]
+
+    # Warm start from the most similar previously decomposed concept
+    if args.warm_start:
+        entry, similarity = find_nearest_concept(
+            args.concept_library, target_image_encodings, exclude=args.train_data_dir
+        )
+        if entry is not None and similarity >= args.warm_start_min_similarity:
+            accelerator.unwrap_model(net_obj).load_state_dict(entry["net_obj_state_dict"])
+            # The attribute network is only meaningful for the same attribute vocabulary
+            if entry["vocabulary_hash"] == file_hash(args.vocabulary_path):
+                accelerator.unwrap_model(net_attr).load_state_dict(entry["net_attr_state_dict"])
+            logger.info(
+                f"Warm start from {entry['data_root']} (similarity {similarity:.4f})"
+            )
+        else:
+            logger.info("No library concept similar enough, starting from scratch")
+
+    # Only nouns make up the object, the full vocabulary holds nothing else
+    if full_vocabulary is not None:
+        mask = torch.ones(num_tokens, device=accelerator.device)
+    else:
+        mask = noun_mask(vocabulary_words).float().to(accelerator.device)
 
     # Get attribute embedding
-    words_attr = []
-    with open(args.vocabulary_path, 'r') as file:
-        for line in file:
-            tokens = tokenizer.encode(line.strip(), add_special_tokens=False)
-            words_attr.append(tokens)
-    attr_token = torch.tensor(words_attr).squeeze(1)
-    attr_embedding = orig_embeds_params[attr_token]
-
-    # Create pipeline
-    pipeline = DiffusionPipeline.from_pretrained(
-        args.pretrained_model_name_or_path,
-        text_encoder=accelerator.unwrap_model(text_encoder),
-        tokenizer=tokenizer,
-        unet=unet,
-        vae=vae,
-        revision=args.revision,
-        torch_dtype=weight_dtype,
-    )
-    pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
-        pipeline.scheduler.config
+    attr_words = attr_vocabulary["words"][:args.word_size]
+    attr_embedding = attr_vocabulary["embeddings"][:args.word_size].to(accelerator.device)
+
+    timestep_sampler = get_timestep_sampler(
+        args.timestep_sampling,
+        noise_scheduler.config.num_train_timesteps,
+        num_buckets=args.timestep_buckets,
     )
-    pipeline = pipeline.to(accelerator.device)
-    pipeline.set_progress_bar_config(disable=True)
 
+    stopper = None
+    if args.early_stopping:
+        stopper = RankingStabilityStopper(
+            top_k=args.early_stopping_top_k,
+            min_overlap=args.early_stopping_min_overlap,
+            loss_tolerance=args.early_stopping_loss_tolerance,
+            patience=args.early_stopping_patience,
+            min_steps=args.early_stopping_min_steps,
+        )
+    stop_training = False
+
+    reset_peak_memory_stats(accelerator.device)
+    profiler = None
+    if args.profile_steps is not None and accelerator.is_main_process:
+        profiler = StepProfiler(
+            args.profile_steps, f"{args.output_dir}/step1", accelerator.device
+        )
+    timer = PhaseTimer(accelerator.device, record_ranges=profiler is not None)
+    preview = None
+    preview_history = []
+    if args.preview and accelerator.is_main_process:
+        preview = PreviewRenderer(
+            unet,
+            vae,
+            tokenizer,
+            noise_scheduler.config,
+            [p for prompts in validation_prompts(args.test_prompt, args.obj_placeholder_token) for p in prompts],
+            accelerator.device,
+            dtype=weight_dtype,
+            resolution=args.preview_resolution,
+            num_inference_steps=args.preview_steps,
+            guidance_scale=args.preview_guidance_scale,
+            images_per_prompt=args.preview_images_per_prompt,
+            batch_size=args.preview_batch_size,
+            time_budget=args.preview_time_budget,
+            compact_context=args.compact_context,
+            seed=args.seed or 0,
+        )
+    loss_history = []
+    step_times = []
+    step_resolutions = []
+    time_to_first_step = None
+    step_start = time.perf_counter()
+    data_start = time.perf_counter()
     for epoch in range(first_epoch, args.num_train_epochs):
         net_obj.train(); net_attr.train()
         for batch in train_dataloader:
+            timer.add("data_loading", time.perf_counter() - data_start)
+            if profiler is not None:
+                profiler.update(global_step)
+                timer.synchronize = profiler.active
             text_encoder.get_input_embeddings().weight.detach_().requires_grad_(False)
             net_attr.requires_grad_(True); net_obj.requires_grad_(True)
 
-            # calculate current embeddings
-            token_embeds = text_encoder.get_input_embeddings().weight
-            alphas_obj = net_obj(vocabulary)
+            if full_vocabulary is not None:
+                with timer.phase("vocabulary_scoring"):
+                    vocabulary_indices, vocabulary_words, vocabulary = full_vocabulary.select(
+                        accelerator.unwrap_model(net_obj)
+                    )
 
-            mask = torch.ones(args.vocabulary_size)
-            for i in range(args.vocabulary_size):
-                word = tokenizer.decode(vocabulary_indices[i])
-                if not nltk.pos_tag([word])[0][1].startswith('NN'):
-                    mask[i] = 0
-            mask = mask.to("cuda:0")
-            masked_alphas_obj = alphas_obj * mask
+            with timer.phase("embedding_composition"):
+                # calculate current embeddings
+                token_embeds = text_encoder.get_input_embeddings().weight
+                alphas_obj = net_obj(vocabulary)
+                masked_alphas_obj = alphas_obj * mask
 
-            _, sorted_obj = torch.sort(masked_alphas_obj.abs(), descending=True)
+                _, sorted_obj = torch.sort(masked_alphas_obj.abs(), descending=True)
 
-            embedding_obj = torch.matmul(masked_alphas_obj, vocabulary)
-            embedding_obj = torch.mul(embedding_obj, 1 / embedding_obj.norm())
-            embedding_obj = torch.mul(embedding_obj, avg_norm)
+                embedding_obj = torch.matmul(masked_alphas_obj, vocabulary)
+                embedding_obj = torch.mul(embedding_obj, 1 / embedding_obj.norm())
+                embedding_obj = torch.mul(embedding_obj, avg_norm)
 
-            alphas_attr = net_attr(attr_embedding)
-            _, sorted_attr = torch.sort(alphas_attr.abs(), descending =True)
-            embedding_attr = torch.matmul(alphas_attr[sorted_attr[:args.num_attr_take]], attr_embedding[sorted_attr[:args.num_attr_take]])
-            embedding_attr = torch.mul(embedding_attr, 1 / embedding_attr.norm())
-            embedding_attr = torch.mul(embedding_attr, avg_norm)
+                alphas_attr = net_attr(attr_embedding)
+                _, sorted_attr = torch.sort(alphas_attr.abs(), descending =True)
+                embedding_attr = torch.matmul(alphas_attr[sorted_attr[:args.num_attr_take]], attr_embedding[sorted_attr[:args.num_attr_take]])
+                embedding_attr = torch.mul(embedding_attr, 1 / embedding_attr.norm())
+                embedding_attr = torch.mul(embedding_attr, avg_norm)
 
-            token_embeds[placeholder_token_id-1] = embedding_attr
-            token_embeds[placeholder_token_id] = embedding_obj
-            text_encoder.get_input_embeddings().weight.requires_grad_(True)
+                token_embeds[placeholder_token_id-1] = embedding_attr
+                token_embeds[placeholder_token_id] = embedding_obj
+                text_encoder.get_input_embeddings().weight.requires_grad_(True)
 
             with accelerator.accumulate([net_attr, net_obj]):
-                # Convert images to latent space
-                latents = (
-                    vae.encode(batch["pixel_values"].to(dtype=weight_dtype))
-                    .latent_dist.sample()
-                    .detach()
-                )
+                # Convert images to latent space, at the resolution of the curriculum
+                resolution = resolution_at(resolution_schedule, global_step)
+                pixel_key = "pixel_values" if resolution == args.resolution else f"pixel_values_{resolution}"
+                with timer.phase("vae_encode"):
+                    latents = (
+                        vae.encode(batch[pixel_key].to(dtype=weight_dtype))
+                        .latent_dist.sample()
+                        .detach()
+                    )
                 latents = latents * 0.18215
+                # Several noise/timestep draws per latent share the same text encoder pass
+                latents = latents.repeat(args.noise_draws_per_latent, 1, 1, 1)
 
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(latents)
                 bsz = latents.shape[0]
                 # Sample a random timestep for each image
-                timesteps = torch.randint(
-                    0,
-                    noise_scheduler.config.num_train_timesteps,
-                    (bsz,),
-                    device=latents.device,
-                )
-                timesteps = timesteps.long()
+                timesteps, timestep_weights = timestep_sampler.sample(bsz, latents.device)
 
                 # Add noise to the latents according to the noise magnitude at each timestep
                 noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
 
-                # Get the text embedding for conditioning
-                encoder_hidden_states = text_encoder(batch["input_ids"])[0].to(dtype=weight_dtype)
-                encoder_hidden_states_obj = text_encoder(batch["input_ids_obj"])[0].to(dtype=weight_dtype)
-
-                # Predict the noise residual
-                model_pred = unet(noisy_latents, timesteps, encoder_hidden_states).sample
-                model_pred_obj = unet(noisy_latents, timesteps, encoder_hidden_states_obj).sample
+                # Autocast keeps the normalizations and softmaxes of the
+                # weight_dtype models in fp32. With fp16, accelerator.backward
+                # scales the loss so the placeholder gradients do not underflow.
+                with accelerator.autocast():
+                    # Get the text embedding for conditioning
+                    with timer.phase("text_encoder"):
+                        encoder_hidden_states = text_encoder(batch["input_ids"])[0]
+                        encoder_hidden_states_obj = text_encoder(batch["input_ids_obj"])[0]
+                    encoder_hidden_states = encoder_hidden_states.repeat(args.noise_draws_per_latent, 1, 1)
+                    encoder_hidden_states_obj = encoder_hidden_states_obj.repeat(args.noise_draws_per_latent, 1, 1)
+
+                    # Predict the noise residual
+                    with timer.phase("unet_forward"):
+                        with timer.record("unet_forward_attr_obj"):
+                            model_pred = unet(noisy_latents, timesteps, encoder_hidden_states).sample
+                        with timer.record("unet_forward_obj"):
+                            model_pred_obj = unet(noisy_latents, timesteps, encoder_hidden_states_obj).sample
 
                 # Get the target for loss depending on the prediction type
                 if noise_scheduler.config.prediction_type == "epsilon":
@@ -713,8 +976,11 @@ def main():
                         f" {noise_scheduler.config.prediction_type}"
                     )
 
-                mse_loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
-                mse_loss_obj = F.mse_loss(model_pred_obj.float(), target.float(), reduction="mean")
+                mse_loss = F.mse_loss(model_pred.float(), target.float(), reduction="none").mean(dim=[1, 2, 3])
+                mse_loss_obj = F.mse_loss(model_pred_obj.float(), target.float(), reduction="none").mean(dim=[1, 2, 3])
+                timestep_sampler.update(timesteps, mse_loss + mse_loss_obj)
+                mse_loss = (mse_loss * timestep_weights).mean()
+                mse_loss_obj = (mse_loss_obj * timestep_weights).mean()
 
                 top_indices = [
                     sorted_obj[i].item() for i in range(args.num_explanation_tokens)
@@ -729,42 +995,142 @@ def main():
 
                 loss = mse_loss + 0.001 * obj_loss + mse_loss_obj
 
-                accelerator.backward(loss)
+                with timer.phase("backward"):
+                    accelerator.backward(loss)
 
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad()
+                with timer.phase("optimizer"):
+                    optimizer.step()
+                    lr_scheduler.step()
+                    optimizer.zero_grad()
 
                 # Make sure not update other embedding except for added token
-                index_no_updates = torch.ones(len(tokenizer), dtype=torch.bool)
-                index_no_updates[placeholder_token_id-1] = False
-                index_no_updates[placeholder_token_id] = False
+                with timer.phase("embedding_restore"):
+                    index_no_updates = torch.ones(len(tokenizer), dtype=torch.bool)
+                    index_no_updates[placeholder_token_id-1] = False
+                    index_no_updates[placeholder_token_id] = False
 
-                with torch.no_grad():
-                    accelerator.unwrap_model(text_encoder).get_input_embeddings().weight[
-                        index_no_updates
-                    ] = orig_embeds_params[index_no_updates]
+                    with torch.no_grad():
+                        accelerator.unwrap_model(text_encoder).get_input_embeddings().weight[
+                            index_no_updates
+                        ] = orig_embeds_params[index_no_updates].to(dtype=weight_dtype)
 
                 # Checks if the accelerator has performed an optimization step behind the scenes
                 if accelerator.sync_gradients:
                     progress_bar.update(1)
                     global_step += 1
+                    loss_history.append(gather_mean(accelerator, loss))
+                    step_times.append(time.perf_counter() - step_start)
+                    step_resolutions.append(resolution)
+                    metrics = step_metrics(
+                        {
+                            "loss": loss_history[-1],
+                            "mse_loss": mse_loss.item(),
+                            "mse_loss_obj": mse_loss_obj.item(),
+                            "obj_loss": obj_loss.item(),
+                        },
+                        timer.step(),
+                        step_times[-1],
+                        total_batch_size,
+                        peak_memory_stats(accelerator.device),
+                    )
+                    metrics["resolution"] = resolution
+                    if global_step == 1:
+                        time_to_first_step = time.perf_counter() - main_start
+                        metrics["time_to_first_step"] = time_to_first_step
+                        logger.info(f"Time to first step: {time_to_first_step:.1f}s")
+                    metrics["lr"] = lr_scheduler.get_last_lr()[0]
+                    accelerator.log(metrics, step=global_step)
+                    step_start = time.perf_counter()
+                    stop_training = global_step >= args.max_train_steps
+                    # Full vocabulary rankings are compared by token id, the vocabulary changes
+                    obj_ranking = sorted_obj if full_vocabulary is None else vocabulary_indices[sorted_obj]
+                    if stopper is not None and stopper.update(
+                        global_step, {"obj": obj_ranking, "attr": sorted_attr}, loss_history[-1]
+                    ):
+                        stop_training = True
 
             if global_step % args.validation_steps == 0:
                 token_embeds[placeholder_token_id] = top_embedding
-        
-                pipeline.text_encoder = accelerator.unwrap_model(text_encoder)
+
                 text_encoder.get_input_embeddings().weight.detach_().requires_grad_(False)
                 net_attr.requires_grad_(False); net_obj.requires_grad_(False)
+
+                if preview is not None and accelerator.sync_gradients:
+                    with timer.phase("validation"):
+                        preview_stats = preview.render(
+                            accelerator.unwrap_model(text_encoder),
+                            f"{args.output_dir}/previews/step1_{global_step:06d}.png",
+                        )
+                    preview_history.append(dict(preview_stats, step=global_step))
+                    accelerator.log(
+                        {"preview/num_prompts": preview_stats["num_prompts"], "time/preview": preview_stats["time"]},
+                        step=global_step,
+                    )
         
-            if global_step == args.max_train_steps:
+            if stop_training:
                 saved_data = {
-                    'net_attr_state_dict': net_attr.state_dict(),
-                    'net_obj_state_dict': net_obj.state_dict()
+                    'net_attr_state_dict': accelerator.unwrap_model(net_attr).state_dict(),
+                    'net_obj_state_dict': accelerator.unwrap_model(net_obj).state_dict(),
+                    'loss_history': loss_history,
+                    'top_attributes': [
+                        attr_words[i] for i in sorted_attr[:args.num_attr_take].tolist()
+                    ],
+                    'top_objects': [
+                        vocabulary_words[i] for i in sorted_obj[:args.num_explanation_tokens].tolist()
+                    ],
+                    # fp32 master vectors, to compare runs across precisions
+                    'placeholder_embeddings': {
+                        'attr': embedding_attr.detach().float().cpu(),
+                        'obj': embedding_obj.detach().float().cpu(),
+                    },
+                    'step_times': step_times,
+                    'step_resolutions': step_resolutions,
+                    'time_to_first_step': time_to_first_step,
+                    'num_processes': accelerator.num_processes,
+                    'peak_memory': peak_memory_stats(accelerator.device),
+                    'processes_in_sync': parameters_in_sync(
+                        accelerator, list(net_attr.parameters()) + list(net_obj.parameters())
+                    ),
                 }
-                torch.save(saved_data, f"{args.output_dir}/step1_params.pt")
+                if stopper is not None:
+                    saved_data['early_stopping'] = stopper.history
+                if batch_plan is not None:
+                    saved_data['batch_plan'] = batch_plan
+                if image_selection is not None:
+                    saved_data['image_selection'] = image_selection
+                if concept_metadata is not None:
+                    saved_data['concept_metadata'] = concept_metadata
+                if quantization is not None:
+                    saved_data['quantization'] = quantization
+                if preview is not None:
+                    saved_data['previews'] = preview_history
+                saved_data['step_time_per_resolution'] = step_time_per_resolution(step_times, step_resolutions)
+                for size, step_time in saved_data['step_time_per_resolution'].items():
+                    logger.info(f"{size}px: {step_time:.3f}s per step")
+                if accelerator.is_main_process:
+                    with timer.phase("checkpoint"):
+                        torch.save(saved_data, f"{args.output_dir}/step1_params.pt")
+                if args.concept_library is not None and accelerator.is_main_process:
+                    add_concept(
+                        args.concept_library,
+                        args.train_data_dir,
+                        target_image_encodings,
+                        saved_data['net_attr_state_dict'],
+                        saved_data['net_obj_state_dict'],
+                        vocabulary_path=args.vocabulary_path,
+                        final_loss=loss_history[-1],
+                    )
                 break
 
+            data_start = time.perf_counter()
+
+        if stop_training:
+            break
+
+    if profiler is not None:
+        profiler.finish()
+    if accelerator.is_main_process:
+        timer.save(f"{args.output_dir}/step1_phase_times.json")
     accelerator.end_training()
 
 if __name__ == "__main__":
@@ -0,0 +1,596 @@
+"""
+Hyperparameter sweep over step1 and step2 in a single process.
+
+Every config of the sweep gets its own ``WeightLearningNetwork``s, optimizer
+and pair of placeholder tokens. The models, the vocabulary and the VAE
+latents of the concept are loaded once and shared. At each step the prompts
+of all configs go through the text encoder in one batch, and their
+conditionings are packed into shared UNet batches over the same noisy
+latents, so the configs are compared under the same noise.
+
+    python train_sweep.py --sweep_config sweep.json \
+        --train_data_dir image/time/ancient_statue/0 --vocabulary_path image/time/attr.txt
+
+where ``sweep.json`` is either a list of configs or a dict of value lists that
+is expanded into a grid, e.g. ``{"learning_rate_attr": [1e-2, 3e-2],
+"num_attr_take": [5, 10]}``. Keys that are not given use the values of the
+regular step1 arguments.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+from accelerate import Accelerator
+from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
+from diffusers.optimization import get_scheduler
+from tqdm.auto import tqdm
+from transformers import CLIPTextModel, CLIPTokenizer
+
+from curriculum import parse_resolution_schedule, resolution_at, schedule_sizes
+from latent_cache import LatentCache
+from attribute_vocabulary import load_attribute_vocabulary, resolve_word_size
+from archive_source import ShardIndex
+from image_selection import list_images, select_concept_images
+from phrase_bank import PhraseBank, object_vocabulary
+from vocabulary_scoring import noun_mask
+from quantization import quantize_frozen_models
+from resources import ensure_nltk_data, load_pretrained
+from timestep_sampler import get_timestep_sampler
+from train_step1 import (
+    PIL_INTERPOLATION,
+    WeightLearningNetwork,
+    get_clip_encodings,
+    get_vocabulary_indices,
+    logger,
+    set_seed,
+)
+from train_step1 import parse_args as parse_train_args
+
+SWEEP_KEYS = [
+    "learning_rate_attr",
+    "learning_rate_obj",
+    "num_attr_take",
+    "num_explanation_tokens",
+    "word_size",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep over step1 and step2.")
+    parser.add_argument('--sweep_config', type=str, required=True, help='JSON file with a list of configs, or a dict of value lists expanded into a grid.')
+    parser.add_argument('--max_train_steps_2', type=int, default=30, help='Number of step2 training steps.')
+    parser.add_argument('--embed_lr', type=float, default=1e-3, help='Learning rate for the step2 embeddings.')
+    parser.add_argument('--max_conditionings_per_unet_pass', type=int, default=4, help='How many conditionings (two per config) are packed into one UNet batch of train_batch_size latents each.')
+    sweep_args, train_args = parser.parse_known_args()
+    args = parse_train_args(train_args)
+    if args.full_vocabulary:
+        # Every config would pick its own vocabulary, the UNet passes share one
+        raise ValueError("--full_vocabulary is not supported by the sweep")
+    return sweep_args, args
+
+
+def load_sweep_configs(path, args):
+    with open(path) as f:
+        spec = json.load(f)
+    if isinstance(spec, dict):
+        keys = list(spec)
+        spec = [
+            dict(zip(keys, values))
+            for values in itertools.product(*(spec[k] for k in keys))
+        ]
+
+    configs = []
+    for overrides in spec:
+        unknown = set(overrides) - set(SWEEP_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown sweep keys {sorted(unknown)}")
+        config = {k: getattr(args, k) for k in SWEEP_KEYS}
+        config.update(overrides)
+        configs.append(config)
+    return configs
+
+
+def compose_attr(net_attr, attr_embedding, num_attr_take, avg_norm):
+    alphas_attr = net_attr(attr_embedding)
+    _, sorted_attr = torch.sort(alphas_attr.abs(), descending=True)
+    top = sorted_attr[:num_attr_take]
+    embedding_attr = torch.matmul(alphas_attr[top], attr_embedding[top])
+    embedding_attr = embedding_attr / embedding_attr.norm() * avg_norm
+    return embedding_attr, sorted_attr
+
+
+def compose_obj(net_obj, vocabulary, mask, avg_norm, num_explanation_tokens=None):
+    masked_alphas_obj = net_obj(vocabulary) * mask
+    _, sorted_obj = torch.sort(masked_alphas_obj.abs(), descending=True)
+    if num_explanation_tokens is None:
+        embedding_obj = torch.matmul(masked_alphas_obj, vocabulary)
+    else:
+        top = sorted_obj[:num_explanation_tokens]
+        embedding_obj = torch.matmul(masked_alphas_obj[top], vocabulary[top])
+    embedding_obj = embedding_obj / embedding_obj.norm() * avg_norm
+    return embedding_obj, masked_alphas_obj, sorted_obj
+
+
+def conditioning_groups(tokenizer, prompts, compact_context, device):
+    """
+    Token ids of ``prompts`` as ``(index of the first prompt, ids)`` groups of
+    consecutive prompts of the same length. The prompts are padded to the
+    maximum length like in the single runs, or not padded at all with
+    ``compact_context``, so no prompt is conditioned on padding tokens.
+    """
+    input_ids = tokenizer(
+        prompts,
+        padding="do_not_pad" if compact_context else "max_length",
+        truncation=True,
+        max_length=tokenizer.model_max_length,
+    ).input_ids
+    groups = []
+    for i, ids in enumerate(input_ids):
+        if groups and len(groups[-1][1][-1]) == len(ids):
+            groups[-1][1].append(ids)
+        else:
+            groups.append((i, [ids]))
+    return [(first, torch.tensor(rows, device=device)) for first, rows in groups]
+
+
+class SweepRun:
+    """Networks, optimizer and results of one config of the sweep."""
+
+    def __init__(self, index, config, attr_embedding, vocabulary_size, device):
+        self.index = index
+        self.config = config
+        self.attr_embedding = attr_embedding[: config["word_size"]]
+        embedding_dim = attr_embedding.shape[1]
+        self.net_attr = WeightLearningNetwork(embedding_dim, config["word_size"]).to(device)
+        self.net_obj = WeightLearningNetwork(embedding_dim, vocabulary_size).to(device)
+        self.loss_history = {1: [], 2: []}
+        self.saved_emb_a = None
+        self.saved_emb_o = None
+
+    def start_stage(self, stage, args, sweep_args, vocabulary, mask, avg_norm):
+        param_groups = [
+            {'params': self.net_attr.parameters(), 'lr': self.config["learning_rate_attr"]},
+            {'params': self.net_obj.parameters(), 'lr': self.config["learning_rate_obj"]},
+        ]
+        if stage == 2:
+            with torch.no_grad():
+                saved_emb_a, _ = compose_attr(
+                    self.net_attr, self.attr_embedding, self.config["num_attr_take"], avg_norm
+                )
+                saved_emb_o, _, _ = compose_obj(
+                    self.net_obj, vocabulary, mask, avg_norm, self.config["num_explanation_tokens"]
+                )
+            self.saved_emb_a = saved_emb_a.clone().requires_grad_(True)
+            self.saved_emb_o = saved_emb_o.clone().requires_grad_(True)
+            param_groups.append({'params': self.saved_emb_a, 'lr': sweep_args.embed_lr})
+            param_groups.append({'params': self.saved_emb_o, 'lr': sweep_args.embed_lr})
+
+        self.optimizer = torch.optim.AdamW(
+            param_groups,
+            betas=(args.adam_beta1, args.adam_beta2),
+            weight_decay=args.adam_weight_decay,
+            eps=args.adam_epsilon,
+        )
+        max_train_steps = args.max_train_steps if stage == 1 else sweep_args.max_train_steps_2
+        self.lr_scheduler = get_scheduler(
+            args.lr_scheduler,
+            optimizer=self.optimizer,
+            num_warmup_steps=args.lr_warmup_steps,
+            num_training_steps=max_train_steps,
+        )
+
+    def compose(self, stage, vocabulary, mask, avg_norm):
+        """
+        Returns the placeholder embeddings of this config and its loss terms
+        that do not depend on the UNet. The current rankings are kept in
+        ``sorted_attr``/``sorted_obj``.
+        """
+        embedding_attr, self.sorted_attr = compose_attr(
+            self.net_attr, self.attr_embedding, self.config["num_attr_take"], avg_norm
+        )
+        if stage == 1:
+            embedding_obj, masked_alphas_obj, self.sorted_obj = compose_obj(
+                self.net_obj, vocabulary, mask, avg_norm
+            )
+            top_indices = self.sorted_obj[: self.config["num_explanation_tokens"]]
+            top_embedding = torch.matmul(masked_alphas_obj[top_indices], vocabulary[top_indices])
+            obj_loss = 1 - torch.cosine_similarity(
+                top_embedding.reshape(1, -1), embedding_obj.reshape(1, -1)
+            )
+            return embedding_attr, embedding_obj, 0.001 * obj_loss.sum()
+
+        embedding_obj, _, self.sorted_obj = compose_obj(
+            self.net_obj, vocabulary, mask, avg_norm, self.config["num_explanation_tokens"]
+        )
+        attr_out = torch.norm(self.saved_emb_a - embedding_attr, p=2) ** 2
+        obj_out = torch.norm(self.saved_emb_o - embedding_obj, p=2) ** 2
+        loss_L2 = torch.mean(attr_out + obj_out)
+        return (
+            0.5 * (self.saved_emb_a + embedding_attr),
+            0.5 * (self.saved_emb_o + embedding_obj),
+            loss_L2,
+        )
+
+    def step(self, scaler=None):
+        # With fp16 the gradients are scaled, the scaler unscales them and
+        # skips the step on overflow
+        if scaler is not None:
+            scaler.step(self.optimizer)
+        else:
+            self.optimizer.step()
+        self.lr_scheduler.step()
+        self.optimizer.zero_grad()
+
+
+def train_stage(
+    stage,
+    runs,
+    args,
+    sweep_args,
+    accelerator,
+    text_encoder,
+    unet,
+    noise_scheduler,
+    latent_cache,
+    timestep_sampler,
+    input_ids,
+    attr_token_ids,
+    obj_token_ids,
+    vocabulary,
+    mask,
+    avg_norm,
+    weight_dtype,
+    resolution_schedule,
+):
+    num_runs = len(runs)
+    # The object prompt weighs 1 in step1 and 0.7 in step2
+    obj_prompt_weight = 1.0 if stage == 1 else 0.7
+    coefficients = torch.tensor(
+        [1.0] * num_runs + [obj_prompt_weight] * num_runs, device=accelerator.device
+    )
+    max_train_steps = args.max_train_steps if stage == 1 else sweep_args.max_train_steps_2
+    chunk_size = sweep_args.max_conditionings_per_unet_pass
+
+    for run in runs:
+        run.net_attr.train(); run.net_obj.train()
+
+    progress_bar = tqdm(range(max_train_steps), disable=not accelerator.is_local_main_process)
+    progress_bar.set_description(f"Sweep step{stage}")
+    for step in range(max_train_steps):
+        text_encoder.get_input_embeddings().weight.detach_().requires_grad_(False)
+        token_embeds = text_encoder.get_input_embeddings().weight
+
+        extra_losses = []
+        for run, attr_id, obj_id in zip(runs, attr_token_ids, obj_token_ids):
+            embedding_attr, embedding_obj, extra_loss = run.compose(stage, vocabulary, mask, avg_norm)
+            token_embeds[attr_id] = embedding_attr
+            token_embeds[obj_id] = embedding_obj
+            extra_losses.append(extra_loss)
+
+        resolution = resolution_at(resolution_schedule, step)
+        latents = latent_cache.sample(args.train_batch_size, resolution).to(dtype=weight_dtype)
+        latents = latents.repeat(args.noise_draws_per_latent, 1, 1, 1)
+        noise = torch.randn_like(latents)
+        bsz = latents.shape[0]
+        timesteps, timestep_weights = timestep_sampler.sample(bsz, latents.device)
+        noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
+
+        if noise_scheduler.config.prediction_type == "epsilon":
+            target = noise
+        elif noise_scheduler.config.prediction_type == "v_prediction":
+            target = noise_scheduler.get_velocity(latents, noise, timesteps)
+        else:
+            raise ValueError(
+                "Unknown prediction type"
+                f" {noise_scheduler.config.prediction_type}"
+            )
+
+        # One text encoder row per conditioning: attribute prompts, then object
+        # prompts, encoded per group of prompts of the same length
+        with accelerator.autocast():
+            encoder_hidden_states = [(first, text_encoder(ids)[0]) for first, ids in input_ids]
+
+        mse_losses = torch.zeros(2 * num_runs, device=accelerator.device)
+        sampler_losses = torch.zeros(bsz, device=accelerator.device)
+        # A UNet pass only packs conditionings of the same length
+        for first, group_states in encoder_hidden_states:
+            for offset in range(0, len(group_states), chunk_size):
+                states = group_states[offset : offset + chunk_size]
+                start = first + offset
+                end = start + len(states)
+                num_conditionings = end - start
+                with accelerator.autocast():
+                    model_pred = unet(
+                        noisy_latents.repeat(num_conditionings, 1, 1, 1),
+                        timesteps.repeat(num_conditionings),
+                        states.repeat_interleave(bsz, dim=0),
+                    ).sample
+                per_sample = F.mse_loss(
+                    model_pred.float(),
+                    target.repeat(num_conditionings, 1, 1, 1).float(),
+                    reduction="none",
+                ).mean(dim=[1, 2, 3]).view(num_conditionings, bsz)
+                sampler_losses += per_sample.detach().sum(dim=0)
+                mse = (per_sample * timestep_weights).mean(dim=1)
+
+                chunk_loss = (coefficients[start:end] * mse).sum()
+                last_chunk = end == 2 * num_runs
+                if last_chunk:
+                    chunk_loss = chunk_loss + torch.stack(extra_losses).sum()
+                # The text encoder graph is shared by all chunks
+                accelerator.backward(chunk_loss, retain_graph=not last_chunk)
+                mse_losses[start:end] = mse.detach()
+
+        timestep_sampler.update(timesteps, sampler_losses / num_runs)
+
+        for n, run in enumerate(runs):
+            run.step(accelerator.scaler)
+            loss = (
+                mse_losses[n]
+                + obj_prompt_weight * mse_losses[num_runs + n]
+                + extra_losses[n].detach()
+            )
+            run.loss_history[stage].append(loss.item())
+        if accelerator.scaler is not None:
+            accelerator.scaler.update()
+
+        progress_bar.update(1)
+
+
+def main():
+    sweep_args, args = parse_args()
+    set_seed(args.seed)
+    ensure_nltk_data(["averaged_perceptron_tagger"], offline=args.offline)
+    resolution_schedule = parse_resolution_schedule(args.resolution_schedule, args.resolution)
+
+    accelerator = Accelerator(mixed_precision=args.mixed_precision)
+    device = accelerator.device
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    configs = load_sweep_configs(sweep_args.sweep_config, args)
+    num_runs = len(configs)
+    logger.info(f"Sweeping {num_runs} configs")
+    start_time = time.perf_counter()
+
+    tokenizer = load_pretrained(
+        CLIPTokenizer,
+        args.pretrained_model_name_or_path,
+        offline=args.offline,
+        subfolder="tokenizer",
+    )
+    noise_scheduler = load_pretrained(
+        DDPMScheduler,
+        args.pretrained_model_name_or_path,
+        offline=args.offline,
+        subfolder="scheduler",
+    )
+    text_encoder = load_pretrained(
+        CLIPTextModel,
+        args.pretrained_model_name_or_path,
+        offline=args.offline,
+        subfolder="text_encoder",
+        revision=args.revision,
+    )
+    vae = load_pretrained(
+        AutoencoderKL,
+        args.pretrained_model_name_or_path,
+        offline=args.offline,
+        subfolder="vae",
+        revision=args.revision,
+    )
+    unet = load_pretrained(
+        UNet2DConditionModel,
+        args.pretrained_model_name_or_path,
+        offline=args.offline,
+        subfolder="unet",
+        revision=args.revision,
+    )
+
+    # One pair of placeholder tokens per config
+    attr_tokens = [f"<{n}>" for n in range(num_runs)]
+    obj_tokens = [f"[{n}]" for n in range(num_runs)]
+    tokenizer.add_tokens(attr_tokens + obj_tokens)
+    attr_token_ids = tokenizer.convert_tokens_to_ids(attr_tokens)
+    obj_token_ids = tokenizer.convert_tokens_to_ids(obj_tokens)
+    text_encoder.resize_token_embeddings(len(tokenizer))
+
+    vae.requires_grad_(False)
+    unet.requires_grad_(False)
+    text_encoder.requires_grad_(False)
+    if args.int8_weights:
+        quantize_frozen_models({"unet": unet, "text_encoder": text_encoder, "vae": vae}, logger)
+
+    weight_dtype = torch.float32
+    if accelerator.mixed_precision == "fp16":
+        weight_dtype = torch.float16
+    elif accelerator.mixed_precision == "bf16":
+        weight_dtype = torch.bfloat16
+
+    unet.to(device, dtype=weight_dtype)
+    vae.to(device, dtype=weight_dtype)
+    text_encoder.to(device)
+
+    # fp32 token table for the vocabularies, the text encoder runs in weight_dtype
+    orig_embeds_params = text_encoder.get_input_embeddings().weight.data.clone()
+    text_encoder.to(dtype=weight_dtype)
+    avg_norm = orig_embeds_params.norm(dim=-1).mean().item()
+
+    # Concept images, without near-duplicates with --dedup_threshold
+    image_paths = None
+    concept_metadata = None
+    if args.train_archive is not None:
+        image_paths, concept_metadata = ShardIndex.from_pattern(
+            args.train_archive, args.archive_index_cache
+        ).read_concept(args.train_data_dir)
+        logger.info(f"Read {len(image_paths)} images of {args.train_data_dir} from {args.train_archive}")
+    elif args.dedup_threshold is not None or args.max_concept_images is not None:
+        image_paths = list_images(args.train_data_dir)
+    target_image_encodings = get_clip_encodings(
+        args.train_data_dir, device, args.clip_model, offline=args.offline, image_paths=image_paths
+    )
+    image_selection = None
+    if args.dedup_threshold is not None or args.max_concept_images is not None:
+        keep, image_selection = select_concept_images(
+            image_paths,
+            target_image_encodings,
+            threshold=args.dedup_threshold,
+            max_images=args.max_concept_images,
+            repeats=args.repeats,
+        )
+        image_paths = [image_paths[i] for i in keep]
+        target_image_encodings = target_image_encodings[keep]
+        logger.info(
+            f"Sweeping on {image_selection['num_kept']} of {image_selection['num_images']} images"
+            f" ({image_selection['num_near_duplicates']} near-duplicates,"
+            f" {image_selection['num_capped']} over --max_concept_images),"
+            f" {image_selection['compute_saved']:.0%} fewer samples per epoch"
+        )
+
+    if image_selection is not None:
+        with open(os.path.join(args.output_dir, "image_selection.json"), "w") as f:
+            json.dump(image_selection, f, indent=2)
+
+    # Object vocabulary and noun mask, shared by all configs
+    phrase_bank = PhraseBank(args.phrase_bank) if args.phrase_bank is not None else None
+    if phrase_bank is not None:
+        vocabulary_indices, vocabulary_words, vocabulary = object_vocabulary(
+            phrase_bank, target_image_encodings, args.vocabulary_size, orig_embeds_params
+        )
+    else:
+        vocabulary_indices = get_vocabulary_indices(
+            args, target_image_encodings, tokenizer, args.vocabulary_size
+        )
+        vocabulary_words = [tokenizer.decode(i) for i in vocabulary_indices]
+        vocabulary = orig_embeds_params[vocabulary_indices]
+    mask = noun_mask(vocabulary_words).float().to(device)
+
+    # Attribute vocabulary, each config uses its first word_size words
+    attr_vocabulary = load_attribute_vocabulary(
+        args.vocabulary_path,
+        tokenizer,
+        orig_embeds_params,
+        args.vocabulary_cache,
+        args.pretrained_model_name_or_path,
+    )
+    attr_words = attr_vocabulary["words"]
+    attr_embedding = attr_vocabulary["embeddings"].to(device)
+    for config in configs:
+        config["word_size"] = resolve_word_size(attr_vocabulary, config["word_size"])
+
+    prompts = [f"a photo of a {a} {o}" for a, o in zip(attr_tokens, obj_tokens)]
+    prompts += [f"a photo of a {o}" for o in obj_tokens]
+    input_ids = conditioning_groups(tokenizer, prompts, args.compact_context, device)
+
+    image_paths = image_paths or [
+        os.path.join(args.train_data_dir, file_path)
+        for file_path in os.listdir(args.train_data_dir)
+    ]
+    latent_cache = LatentCache(
+        vae,
+        image_paths,
+        schedule_sizes(resolution_schedule),
+        PIL_INTERPOLATION["bicubic"],
+        center_crop=args.center_crop,
+        device=device,
+        dtype=weight_dtype,
+    )
+    timestep_sampler = get_timestep_sampler(
+        args.timestep_sampling,
+        noise_scheduler.config.num_train_timesteps,
+        num_buckets=args.timestep_buckets,
+    )
+    setup_time = time.perf_counter() - start_time
+
+    runs = [
+        SweepRun(n, config, attr_embedding, args.vocabulary_size, device)
+        for n, config in enumerate(configs)
+    ]
+
+    stage_times = {}
+    for stage in [1, 2]:
+        for run in runs:
+            run.start_stage(stage, args, sweep_args, vocabulary, mask, avg_norm)
+        stage_start = time.perf_counter()
+        train_stage(
+            stage,
+            runs,
+            args,
+            sweep_args,
+            accelerator,
+            text_encoder,
+            unet,
+            noise_scheduler,
+            latent_cache,
+            timestep_sampler,
+            input_ids,
+            attr_token_ids,
+            obj_token_ids,
+            vocabulary,
+            mask,
+            avg_norm,
+            weight_dtype,
+            resolution_schedule,
+        )
+        stage_times[stage] = time.perf_counter() - stage_start
+
+        for run in runs:
+            run_dir = os.path.join(args.output_dir, f"config_{run.index}")
+            os.makedirs(run_dir, exist_ok=True)
+            torch.save(
+                {
+                    'net_attr_state_dict': run.net_attr.state_dict(),
+                    'net_obj_state_dict': run.net_obj.state_dict(),
+                    'loss_history': run.loss_history[stage],
+                    'config': run.config,
+                },
+                f"{run_dir}/step{stage}_params.pt",
+            )
+
+    results = []
+    for run in runs:
+        row = {"config": run.index}
+        row.update(run.config)
+        for stage in [1, 2]:
+            losses = run.loss_history[stage][-5:]
+            row[f"step{stage}_final_loss"] = sum(losses) / len(losses)
+        row["top_attributes"] = " ".join(
+            attr_words[i]
+            for i in run.sorted_attr[: run.config["num_attr_take"]].tolist()
+        )
+        row["top_objects"] = " ".join(
+            vocabulary_words[i]
+            for i in run.sorted_obj[: run.config["num_explanation_tokens"]].tolist()
+        )
+        results.append(row)
+
+    with open(os.path.join(args.output_dir, "sweep_results.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+    with open(os.path.join(args.output_dir, "sweep_results.json"), "w") as f:
+        json.dump(
+            {
+                "results": results,
+                "setup_time": setup_time,
+                "step1_time": stage_times[1],
+                "step2_time": stage_times[2],
+            },
+            f,
+            indent=2,
+        )
+
+    columns = ["config"] + SWEEP_KEYS + ["step1_final_loss", "step2_final_loss"]
+    print(" | ".join(columns))
+    for row in results:
+        print(" | ".join(
+            f"{row[c]:.4g}" if isinstance(row[c], float) else str(row[c]) for c in columns
+        ))
+
+
+if __name__ == "__main__":
+    main()
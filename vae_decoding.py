@@ -0,0 +1,136 @@
+"""
+Memory-bounded VAE decoding for high resolution outputs.
+
+- Tiled: the latents are decoded in overlapping ``tile_size x tile_size``
+  tiles (in latent pixels) and the overlaps are blended with linear ramps, so
+  the decoder memory depends on the tile size instead of the resolution.
+- Sequential: at most ``batch_size`` images are decoded at once.
+
+``plan_decode`` picks both for a memory budget, by measuring the decode of
+one and two images like ``batch_planner.plan_batch_size`` does for training.
+``enable_memory_efficient_decode`` makes a ``StableDiffusionPipeline`` decode
+this way.
+"""
+import torch
+
+from batch_planner import MEMORY_MARGIN, _is_out_of_memory
+from memory_utils import available_memory_mb, measure_peak_memory_mb
+
+# In latent pixels, 512 and 128 image pixels for Stable Diffusion
+DEFAULT_TILE_SIZE = 64
+DEFAULT_OVERLAP = 16
+
+
+def _tile_starts(size, tile_size, stride):
+    starts = list(range(0, max(size - tile_size, 0) + 1, stride))
+    if starts[-1] + tile_size < size:
+        starts.append(size - tile_size)
+    return starts
+
+
+def _ramp(length, overlap, start, end, device):
+    """1 inside, rising linearly over ``overlap`` pixels on the sides that overlap a neighbour."""
+    weights = torch.ones(length, device=device)
+    ramp = torch.arange(1, overlap + 1, device=device, dtype=torch.float32) / (overlap + 1)
+    if overlap and start:
+        weights[:overlap] = ramp
+    if overlap and end:
+        weights[-overlap:] = torch.minimum(weights[-overlap:], ramp.flip(0))
+    return weights
+
+
+def tiled_decode(vae, latents, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_OVERLAP):
+    """``vae.decode(latents).sample`` computed tile by tile."""
+    height, width = latents.shape[-2:]
+    if height <= tile_size and width <= tile_size:
+        return vae.decode(latents).sample
+    scale = 2 ** (len(vae.config.block_out_channels) - 1)
+    # Small tiles keep a positive stride
+    overlap = min(overlap, tile_size // 4)
+    stride = tile_size - overlap
+    rows = _tile_starts(height, tile_size, stride)
+    cols = _tile_starts(width, tile_size, stride)
+
+    image = torch.zeros(
+        latents.shape[0], vae.config.out_channels, height * scale, width * scale,
+        device=latents.device, dtype=torch.float32,
+    )
+    weight = torch.zeros(1, 1, height * scale, width * scale, device=latents.device)
+    for i, y in enumerate(rows):
+        for j, x in enumerate(cols):
+            tile = vae.decode(latents[:, :, y : y + tile_size, x : x + tile_size]).sample.float()
+            tile_height, tile_width = tile.shape[-2:]
+            mask = torch.outer(
+                _ramp(tile_height, overlap * scale, i > 0, i < len(rows) - 1, latents.device),
+                _ramp(tile_width, overlap * scale, j > 0, j < len(cols) - 1, latents.device),
+            )
+            y0, x0 = y * scale, x * scale
+            image[:, :, y0 : y0 + tile_height, x0 : x0 + tile_width] += tile * mask
+            weight[:, :, y0 : y0 + tile_height, x0 : x0 + tile_width] += mask
+    return (image / weight).to(latents.dtype)
+
+
+def decode_latents(vae, latents, tile_size=None, overlap=DEFAULT_OVERLAP, batch_size=None):
+    """Images in [0, 1], channels last, ``batch_size`` at a time and tiled with ``tile_size``."""
+    latents = 1 / 0.18215 * latents
+    images = []
+    for chunk in latents.split(batch_size or len(latents)):
+        if tile_size is None:
+            image = vae.decode(chunk).sample
+        else:
+            image = tiled_decode(vae, chunk, tile_size, overlap)
+        images.append((image / 2 + 0.5).clamp(0, 1).permute(0, 2, 3, 1))
+    return torch.cat(images)
+
+
+def plan_decode(vae, latent_shape, memory_budget_mb=None, tile_size=None, overlap=DEFAULT_OVERLAP):
+    """
+    Number of images decoded at once, and the tile size, for latents of
+    ``latent_shape`` (C, H, W). Tiles when a single image does not fit.
+    Returns the decision as a dict.
+    """
+    device = vae.device
+    if memory_budget_mb is None:
+        memory_budget_mb = available_memory_mb(device)
+    budget = MEMORY_MARGIN * memory_budget_mb
+
+    def measure(batch_size, tile):
+        latents = torch.randn(batch_size, *latent_shape, device=device, dtype=vae.dtype)
+        with torch.no_grad():
+            return measure_peak_memory_mb(lambda: decode_latents(vae, latents, tile, overlap), device)
+
+    peak_1 = None
+    if tile_size is None:
+        try:
+            peak_1 = measure(1, None)
+        except RuntimeError as e:
+            if not _is_out_of_memory(e):
+                raise
+            torch.cuda.empty_cache()
+        if peak_1 is None or peak_1 > budget:
+            tile_size = DEFAULT_TILE_SIZE
+            peak_1 = None
+    if peak_1 is None:
+        peak_1 = measure(1, tile_size)
+    peak_2 = measure(2, tile_size)
+    # Measurement noise can hide the growth, assume the worst then
+    per_image = peak_2 - peak_1 if peak_2 > peak_1 else peak_1
+    fixed = max(peak_1 - per_image, 0.0)
+    batch_size = max(int((budget - fixed) // per_image), 1)
+    return {
+        "batch_size": batch_size,
+        "tile_size": tile_size,
+        "memory_budget_mb": memory_budget_mb,
+        "per_image_memory_mb": per_image,
+        "estimated_peak_memory_mb": fixed + per_image * batch_size,
+    }
+
+
+def enable_memory_efficient_decode(pipeline, tile_size=None, overlap=DEFAULT_OVERLAP, batch_size=None):
+    """Makes ``pipeline`` decode with ``decode_latents`` instead of the whole batch at once."""
+
+    def decode(latents):
+        images = decode_latents(pipeline.vae, latents, tile_size, overlap, batch_size)
+        return images.cpu().float().numpy()
+
+    pipeline.decode_latents = decode
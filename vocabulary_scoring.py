@@ -0,0 +1,108 @@
+"""
+Object decomposition over the whole token table.
+
+The object vocabulary is normally the ``vocabulary_size`` tokens closest to
+the mean image embedding, and words ranked below are never seen by
+``net_obj``. In full-vocabulary mode every noun token of the tokenizer is a
+candidate instead:
+
+- the noun mask is computed once per tokenizer and cached, and only the noun
+  tokens are kept (the other ones always had a zero weight),
+- every step, ``net_obj`` scores all the candidates without gradients, in
+  chunks and in reduced precision,
+- the ``vocabulary_size`` best ones form the vocabulary of the step, so the
+  composition, the gradients and ``net_obj`` itself are the same size as in
+  the default mode.
+"""
+import os
+
+import nltk
+import torch
+import torch.nn.functional as F
+
+from attribute_vocabulary import tokenizer_hash
+
+SCORING_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def noun_mask(words):
+    return torch.tensor([nltk.pos_tag(w.split() or [w])[-1][1].startswith("NN") for w in words])
+
+
+def noun_tokens(tokenizer, cache_dir=None):
+    """Ids and words of the noun tokens of the base vocabulary of ``tokenizer``."""
+    vocab = getattr(tokenizer, "encoder", None) or tokenizer.get_vocab()
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f"noun_tokens_{tokenizer_hash(tokenizer)[:16]}.pt")
+        if os.path.isfile(cache_path):
+            cached = torch.load(cache_path)
+            return cached["token_ids"], cached["words"]
+
+    special_ids = set(tokenizer.all_special_ids)
+    token_ids = [i for i in sorted(vocab.values()) if i not in special_ids]
+    words = [tokenizer.decode([i]).strip() for i in token_ids]
+    mask = noun_mask(words)
+    token_ids = torch.tensor(token_ids)[mask]
+    words = [w for w, m in zip(words, mask.tolist()) if m]
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        torch.save({"token_ids": token_ids, "words": words}, tmp_path)
+        os.replace(tmp_path, cache_path)
+    return token_ids, words
+
+
+def scoring_dtype(precision, device):
+    """fp16 on CUDA and bf16 on CPU by default, CPU matmuls have no fp16 kernels."""
+    if precision is None:
+        precision = "fp16" if torch.device(device).type == "cuda" else "bf16"
+    return SCORING_DTYPES[precision]
+
+
+@torch.no_grad()
+def top_k_tokens(net, embeddings, k, chunk_size=8192):
+    """
+    Indices of the ``k`` rows of ``embeddings`` with the largest
+    ``WeightLearningNetwork`` weight, best first. ``embeddings`` is scored in
+    its own dtype.
+    """
+    dtype = embeddings.dtype
+    hidden_weight = net.hidden_layer.weight.to(dtype)
+    hidden_bias = net.hidden_layer.bias.to(dtype)
+    weight = net.weight_layer.weight.to(dtype)
+    best_scores = torch.empty(0, device=embeddings.device)
+    best_indices = torch.empty(0, dtype=torch.long, device=embeddings.device)
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = embeddings[start : start + chunk_size]
+        # The weights are sigmoids, increasing in the logits
+        logits = F.linear(F.relu(F.linear(chunk, hidden_weight, hidden_bias)), weight).reshape(-1)
+        scores = torch.cat([best_scores, logits.float()])
+        indices = torch.cat([
+            best_indices, torch.arange(start, start + len(chunk), device=embeddings.device)
+        ])
+        best_scores, top = torch.topk(scores, min(k, len(scores)))
+        best_indices = indices[top]
+    return best_indices
+
+
+class FullVocabulary:
+    """The noun tokens of ``tokenizer``, from which every step picks its vocabulary."""
+
+    def __init__(self, tokenizer, token_table, size, cache_dir=None, precision=None, chunk_size=8192):
+        token_ids, self.words = noun_tokens(tokenizer, cache_dir)
+        self.token_ids = token_ids.to(token_table.device)
+        self.token_table = token_table
+        self.embeddings = token_table[self.token_ids].to(scoring_dtype(precision, token_table.device))
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def select(self, net):
+        """Token ids, words and embeddings of the ``size`` best tokens for ``net``."""
+        top = top_k_tokens(net, self.embeddings, self.size, self.chunk_size)
+        token_ids = self.token_ids[top]
+        return token_ids, [self.words[i] for i in top.tolist()], self.token_table[token_ids]